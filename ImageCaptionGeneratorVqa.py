@@ -37,106 +37,2293 @@ STATUS_STYLE = """
     font-style: italic;
 """
 
+import argparse
+import base64
+import ctypes
+import gc
+import hashlib
+import io
+import itertools
+import json
+import math
+import os
+import queue
+import re
+import sqlite3
 import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
 import requests
-from PIL import Image
+from PIL import Image, ImageChops, ImageSequence, ImageStat, UnidentifiedImageError
 from PySide6.QtWidgets import (
     QApplication, QMainWindow, QVBoxLayout, QHBoxLayout, 
     QLabel, QTextEdit, QPushButton, QWidget, QFrame, QFileDialog, 
-    QSizePolicy
+    QSizePolicy, QComboBox, QCheckBox, QDialog, QLineEdit, QListWidget, QListWidgetItem
 )
-from PySide6.QtGui import QFont, QPixmap, QIcon
-from PySide6.QtCore import Qt, QThread, Signal
-from transformers import BlipProcessor, BlipForConditionalGeneration, BlipForQuestionAnswering
+from PySide6.QtGui import QFont, QImage, QPixmap, QIcon
+from PySide6.QtCore import Qt, QThread, QTimer, Signal
+# torch and transformers are imported inside the functions that need them: importing them
+# costs seconds, and the window should be usable before the first model is requested
+
+CAPTION_CHECKPOINT = "Salesforce/blip-image-captioning-large"
+QA_CHECKPOINT = "Salesforce/blip-vqa-base"
+# Checkpoints selectable by name per request; Hub ids and local paths are accepted as well
+CAPTION_MODELS = {"large": "Salesforce/blip-image-captioning-large", "base": "Salesforce/blip-image-captioning-base"}
+QA_MODELS = {"base": "Salesforce/blip-vqa-base", "capfilt-large": "Salesforce/blip-vqa-capfilt-large"}
+MODEL_MEMORY_BUDGET_MB = 4096  # Enough for the default caption and VQA models in fp32
+MODEL_IDLE_TIMEOUT = 600  # Seconds after which an unused model is unloaded; 0 keeps models loaded
+MAX_NEW_TOKENS = 50
+IMAGE_EXTENSIONS = (".png", ".xpm", ".jpg", ".jpeg", ".bmp", ".gif")
+EMBEDDING_CACHE_BYTES = 256 * 1024 * 1024  # Roughly 80 images for the ViT-B VQA encoder
+DATA_DIR = os.path.join(os.path.expanduser("~"), ".image_caption_vqa")
+RESULT_CACHE_PATH = os.path.join(DATA_DIR, "results.sqlite3")
+RESULT_CACHE_MAX_ENTRIES = 200000
+RESULT_CACHE_PRUNE_INTERVAL = 1000  # Inserts between enforcing RESULT_CACHE_MAX_ENTRIES
+RESULT_CACHE_TOUCH_INTERVAL = 3600  # Seconds before a hit updates an entry's last use again
+NEAR_DUPLICATE_THRESHOLD = 3  # Differing bits (of 64) at which a stored caption is reused; -1 disables
+SEARCH_INDEX_PATH = os.path.join(DATA_DIR, "search.sqlite3")
+SEARCH_RESULT_LIMIT = 50  # Images returned per search
+SEARCH_RANKED_MATCHES = 20000  # Queries matching more entries are returned newest first, unranked
+SNAPSHOT_DIR = os.path.join(DATA_DIR, "snapshots")
+SESSION_STORE_PATH = os.path.join(DATA_DIR, "sessions.sqlite3")
+INGEST_MAX_SIDE = 1024  # Decoded images are reduced to this; BLIP itself only sees 384x384
+INGEST_MAX_PIXELS = 120_000_000  # Larger inputs are rejected before they are decoded
+THUMBNAIL_SIZE = (160, 160)
+PRECISION_MODES = ("fp32", "int8", "bf16")
+BACKENDS = ("torch", "onnx")
+ONNX_EXPORT_DIR = os.path.join(DATA_DIR, "onnx")
+ONNX_OPSET = 17
+# Space clean-up transformers applies after decoding (clean_up_tokenization_spaces)
+TOKENIZATION_CLEANUP = [(" .", "."), (" ?", "?"), (" !", "!"), (" ,", ","), (" ' ", "'"), (" n't", "n't"),
+                        (" 'm", "'m"), (" 's", "'s"), (" 've", "'ve"), (" 're", "'re")]
+BENCHMARK_QUESTION = "What is in the picture?"
+BENCHMARK_IMAGE_SIZES = ((640, 480), (1920, 1080), (4000, 3000))
+BENCHMARK_BATCH_SIZES = (1, 4, 8)
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+TRACE_STAGES = ("queue_wait", "load", "decode", "lookup", "preprocess", "encode", "generate", "detokenize")
+THREAD_POLICIES = ("default", "latency", "throughput")
+SEQUENCE_CHANGE_THRESHOLD = 0.04  # Mean pixel difference (0-1) from the last captioned frame
+SEQUENCE_FOLDER_FPS = 25  # Frame rate of numbered frame folders
+SEQUENCE_SIGNATURE_SIZE = (32, 32)  # Grayscale thumbnail frames are compared at
+TILE_SIZE = 1024  # Side of a region tile in tiled captioning, in pixels of the original image
+TILE_OVERLAP = 0.25  # Fraction of a tile shared with each neighbour
+TILE_MAX_COUNT = 16  # Tiles are made larger than TILE_SIZE when more would be needed
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8765
+SERVER_MAX_BATCH_SIZE = 8
+SERVER_MAX_WAIT_MS = 20
+REPLICA_MAX_FAILED_STARTS = 3  # A replica that fails to load this many times in a row fails its pool
+PIPELINE_PREFETCH_BATCHES = 3  # Batches decoded ahead of the model by caption-batch --workers
+
+
+def snapshot_dir_for(checkpoint):
+    return os.path.join(SNAPSHOT_DIR, checkpoint.strip("/").replace("/", "--"))
+
+
+def checkpoint_source_revision(checkpoint):
+    # Revision from_pretrained would load, found without loading it: the modification time of a
+    # local checkpoint, or the commit of a Hub checkpoint's files in the local Hugging Face cache.
+    # None if the checkpoint is not downloaded
+    if os.path.isdir(checkpoint):
+        return str(os.path.getmtime(checkpoint))
+    from huggingface_hub import try_to_load_from_cache
+
+    config_path = try_to_load_from_cache(checkpoint, "config.json")
+    return os.path.basename(os.path.dirname(config_path)) if isinstance(config_path, str) else None
+
+
+def snapshot_versions(checkpoint):
+    # What a snapshot depends on: a pickled model only loads into the torch and transformers
+    # versions it was written with, and only matches the checkpoint revision it came from
+    from importlib.metadata import version
+
+    return {"revision": checkpoint_source_revision(checkpoint), "transformers": version("transformers"),
+            "torch": version("torch")}
+
+
+def snapshot_is_current(checkpoint):
+    # A snapshot whose checkpoint is no longer in the Hub cache is still used, as there is
+    # nothing newer to load instead
+    snapshot_dir = snapshot_dir_for(checkpoint)
+    try:
+        with open(os.path.join(snapshot_dir, "snapshot.json"), encoding="utf-8") as f:
+            stored = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if not os.path.exists(os.path.join(snapshot_dir, "model.pt")):
+        return False
+    current = snapshot_versions(checkpoint)
+    if current["revision"] is None:
+        current["revision"] = stored.get("revision")
+    return stored == current
+
+
+def write_snapshot(checkpoint, processor, model):
+    # Pickle the ready-to-run model next to its processor. torch.load(mmap=True) maps the
+    # tensor storage straight from this file, skipping from_pretrained's deserialization.
+    # snapshot.json records the versions it was made from; a snapshot that no longer matches
+    # them is written again on the next load
+    import torch
+
+    snapshot_dir = snapshot_dir_for(checkpoint)
+    os.makedirs(snapshot_dir, exist_ok=True)
+    processor.save_pretrained(snapshot_dir)
+    temp_path = os.path.join(snapshot_dir, f"model.pt.{os.getpid()}.tmp")
+    torch.save(model, temp_path)
+    os.replace(temp_path, os.path.join(snapshot_dir, "model.pt"))
+    temp_path = os.path.join(snapshot_dir, f"snapshot.json.{os.getpid()}.tmp")
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(snapshot_versions(checkpoint), f)
+    os.replace(temp_path, os.path.join(snapshot_dir, "snapshot.json"))
+
+
+def apply_precision(model, precision):
+    # int8 swaps every nn.Linear for a dynamically quantized one (weights stored as int8,
+    # activations quantized per batch); bf16 casts all weights. Both only make sense on CPU
+    import torch
+
+    if precision == "int8":
+        # torch deprecates its quantized tensors in favour of torchao, but has no replacement of its
+        # own that is as fast on CPU, so the deprecation warnings of this one call are silenced
+        import warnings
+
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", category=DeprecationWarning)
+            warnings.filterwarnings("ignore", category=FutureWarning)
+            warnings.filterwarnings("ignore", message=".*deprecated.*", category=UserWarning)
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8,
+                                                           inplace=True)
+    elif precision == "bf16":
+        model = model.to(torch.bfloat16)
+    elif precision != "fp32":
+        raise ValueError(f"Unknown precision mode: {precision}")
+    model.eval()
+    model.inference_precision = precision
+    return model
+
+
+def model_precision(model):
+    return getattr(model, "inference_precision", "fp32")
+
+
+def load_blip_checkpoint(checkpoint, model_class_name, use_snapshot=False, precision="fp32", backend="torch",
+                         thread_budget=None):
+    if backend == "onnx":
+        # Importing transformers pulls in torch, so the ONNX path uses its own processor
+        if precision != "fp32":
+            raise ValueError("Precision modes only apply to the torch backend")
+        export_dir = export_onnx(checkpoint, model_class_name)
+        return OnnxBlipProcessor(export_dir), OnnxBlipModel(export_dir, thread_budget)
+
+    import transformers
+
+    snapshot_dir = snapshot_dir_for(checkpoint)
+    snapshot_file = os.path.join(snapshot_dir, "model.pt")
+    if use_snapshot and snapshot_is_current(checkpoint):
+        import torch
+
+        processor = transformers.BlipProcessor.from_pretrained(snapshot_dir)
+        model = torch.load(snapshot_file, mmap=True, weights_only=False)
+        return processor, apply_precision(model, precision)
+
+    processor = transformers.BlipProcessor.from_pretrained(checkpoint)
+    model = getattr(transformers, model_class_name).from_pretrained(checkpoint)
+    if use_snapshot:
+        # Snapshots always hold the fp32 weights so every precision mode can start from them
+        write_snapshot(checkpoint, processor, model)
+    return processor, apply_precision(model, precision)
+
+
+def resolve_checkpoint(kind, name=None):
+    # Checkpoint of a model name from CAPTION_MODELS / QA_MODELS, a Hub id or a local path;
+    # no name is the default checkpoint
+    if kind == "caption":
+        return CAPTION_MODELS.get(name, name) if name else CAPTION_CHECKPOINT
+    return QA_MODELS.get(name, name) if name else QA_CHECKPOINT
+
+
+def load_caption_model(use_snapshot=False, precision="fp32", backend="torch", thread_budget=None, name=None):
+    return load_blip_checkpoint(resolve_checkpoint("caption", name), "BlipForConditionalGeneration", use_snapshot,
+                                precision, backend, thread_budget)
+
+
+def load_qa_model(use_snapshot=False, precision="fp32", backend="torch", thread_budget=None, name=None):
+    return load_blip_checkpoint(resolve_checkpoint("answer", name), "BlipForQuestionAnswering", use_snapshot,
+                                precision, backend, thread_budget)
+
+
+def model_memory_bytes(model):
+    # Size of a model's weights: its export files for ONNX Runtime, its state dict for torch
+    # (which also holds the packed weights of int8 layers)
+    if isinstance(model, OnnxBlipModel):
+        return sum(os.path.getsize(os.path.join(model.export_dir, name))
+                   for name in os.listdir(model.export_dir) if ".onnx" in name)
+    import torch
+
+    total = 0
+    for value in model.state_dict().values():
+        for tensor in value if isinstance(value, tuple) else (value,):
+            if isinstance(tensor, torch.Tensor):
+                total += tensor.numel() * tensor.element_size()
+    return total
+
+
+def release_memory():
+    # Unloaded weights go back to the allocator, which keeps freed blocks for reuse; glibc can be
+    # asked to return them to the system
+    gc.collect()
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+class ThreadBudget:
+    # CPU share of one model. None leaves the library default. torch reads its intra-op thread
+    # count per calling thread, so the budget is applied from the thread that runs the model;
+    # ONNX Runtime sessions take theirs when they are created
+    def __init__(self, intra_op=None, inter_op=None, cores=None):
+        self.intra_op = intra_op
+        self.inter_op = inter_op
+        self.cores = cores
+
+    def apply(self):
+        if self.cores and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, self.cores)  # 0 is the calling thread on Linux
+        if self.intra_op and "torch" in sys.modules:
+            sys.modules["torch"].set_num_threads(self.intra_op)
+
+    def split(self, count):
+        # count budgets sharing this one's threads between replica processes, one thread each at
+        # least. Pinned budgets hand each replica its own slice of the cores
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else None
+        threads = self.intra_op or (len(cores) if cores else os.cpu_count() or 1)
+        per_replica = max(1, threads // count)
+        return [ThreadBudget(per_replica, 1, [self.cores[(index * per_replica + offset) % len(self.cores)]
+                                              for offset in range(per_replica)] if self.cores else None)
+                for index in range(count)]
+
+    def describe(self):
+        parts = [f"{self.intra_op or 'default'} intra-op", f"{self.inter_op or 'default'} inter-op"]
+        if self.cores:
+            parts.append(f"cores {min(self.cores)}-{max(self.cores)}")
+        return ", ".join(parts)
+
+
+class ExecutionPolicy:
+    # How the caption and VQA models share the CPU:
+    #   default     library defaults; both models may run at once and each uses every core
+    #   latency     one model runs at a time (the other waits) and gets every core
+    #   throughput  the cores are split between the models, which run concurrently; with pin,
+    #               each model is also bound to its own cores
+    def __init__(self, name="default", cpu_count=None, pin=False):
+        if name not in THREAD_POLICIES:
+            raise ValueError(f"Unknown thread policy {name!r}")
+        self.name = name
+        self.pin = pin
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else None
+        cpu_count = cpu_count or (len(cores) if cores else os.cpu_count() or 1)
+        self.gate = threading.Lock() if name == "latency" else None
+
+        if name == "default":
+            self.budgets = {"caption": ThreadBudget(), "answer": ThreadBudget()}
+        elif name == "latency":
+            self.budgets = {kind: ThreadBudget(cpu_count, 1) for kind in ("caption", "answer")}
+        else:
+            # Captioning runs on every upload, so it gets the larger half
+            caption_threads = max(1, (cpu_count + 1) // 2)
+            answer_threads = max(1, cpu_count - caption_threads)
+            caption_cores = answer_cores = None
+            if pin and cores and len(cores) > 1:
+                caption_cores = cores[:caption_threads]
+                answer_cores = cores[caption_threads:]
+            self.budgets = {
+                "caption": ThreadBudget(caption_threads, 1, caption_cores),
+                "answer": ThreadBudget(answer_threads, 1, answer_cores),
+            }
+
+    def budget(self, kind):
+        return self.budgets.get(kind, ThreadBudget())
+
+    @contextmanager
+    def run(self, trace=None):
+        # Held around each model call; only the latency policy makes the models take turns.
+        # Waiting for the other model counts as queue wait
+        if self.gate is None:
+            yield
+            return
+        with span(trace, "queue_wait"):
+            self.gate.acquire()
+        try:
+            yield
+        finally:
+            self.gate.release()
+
+    def apply_process_settings(self):
+        # The inter-op pool is process-wide and can only be sized before torch first uses it
+        inter_op = max((budget.inter_op or 0) for budget in self.budgets.values())
+        if inter_op and "torch" in sys.modules:
+            try:
+                sys.modules["torch"].set_num_interop_threads(inter_op)
+            except RuntimeError:
+                pass
+
+    def describe(self):
+        models = "; ".join(f"{kind}: {budget.describe()}" for kind, budget in self.budgets.items())
+        mode = ", one model at a time" if self.gate is not None else ""
+        return f"{self.name} policy{mode} ({models})"
+
+
+class ModelRegistry:
+    # Models loaded on demand and shared by everything that runs them, keyed by kind ("caption"
+    # or "answer") and checkpoint. Callers borrow a model with acquire() and a borrowed model is
+    # never unloaded. Loading a model that does not fit in max_bytes first unloads the least
+    # recently used idle models, and a background sweep unloads models unused for idle_timeout
+    # seconds. The next acquire() of an unloaded model loads it again
+    MODEL_CLASSES = {"caption": "BlipForConditionalGeneration", "answer": "BlipForQuestionAnswering"}
+
+    def __init__(self, max_bytes=MODEL_MEMORY_BUDGET_MB * 1024 * 1024, idle_timeout=MODEL_IDLE_TIMEOUT,
+                 use_snapshot=False, precisions=None, backend="torch", policy=None, result_cache=None):
+        self.max_bytes = max_bytes
+        self.idle_timeout = idle_timeout
+        self.use_snapshot = use_snapshot
+        self.precisions = precisions or {}
+        self.backend = backend
+        self.policy = policy or ExecutionPolicy()
+        self.result_cache = result_cache
+        self.loads = 0
+        self.unloads = 0
+        self._entries = OrderedDict()  # Least recently used first
+        self._sizes = {}  # Last known size per model, to make room before it is loaded again
+        self._load_locks = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        if idle_timeout:
+            threading.Thread(target=self._sweep_loop, daemon=True).start()
+
+    @contextmanager
+    def acquire(self, kind, name=None, trace=None):
+        # Borrow (processor, model) of a model name (see resolve_checkpoint), loading it if needed
+        entry = self._checkout((kind, resolve_checkpoint(kind, name)), trace)
+        try:
+            yield entry["processor"], entry["model"]
+        finally:
+            with self._lock:
+                entry["users"] -= 1
+                entry["last_used"] = time.monotonic()
+                # Models borrowed at the same time may have pushed the registry over its budget
+                unloaded = self._make_room(0)
+            if unloaded:
+                release_memory()
+
+    def precision(self, kind):
+        # What model_precision() reports for the models of a kind, known before they are loaded
+        return "onnx" if self.backend == "onnx" else self.precisions.get(kind, "fp32")
+
+    def preload(self, kind, name=None):
+        # Seconds spent loading the model, 0 if it was loaded already
+        trace = RequestTrace()
+        with self.acquire(kind, name, trace):
+            pass
+        return trace.stages.get("load", 0.0)
+
+    def _checkout(self, key, trace):
+        with self._lock:
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+        # Requests for a model that is being loaded wait for that load instead of starting another
+        with load_lock:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    entry["users"] += 1
+                    self._entries.move_to_end(key)
+                    return entry
+                unloaded = self._make_room(self._sizes.get(key, 0))
+            if unloaded:
+                release_memory()
+
+            kind, checkpoint = key
+            with span(trace, "load"):
+                processor, model = load_blip_checkpoint(checkpoint, self.MODEL_CLASSES[kind], self.use_snapshot,
+                                                        self.precisions.get(kind, "fp32"), self.backend,
+                                                        self.policy.budget(kind))
+            if self.result_cache is not None:
+                self.result_cache.sync_checkpoint(model.name_or_path, checkpoint_revision(model))
+            entry = {"processor": processor, "model": model, "bytes": model_memory_bytes(model), "users": 1,
+                     "last_used": time.monotonic()}
+            with self._lock:
+                self._entries[key] = entry
+                self._sizes[key] = entry["bytes"]
+                self.loads += 1
+                # A first load only learns the model's size now
+                unloaded = self._make_room(0)
+            if unloaded:
+                release_memory()
+            print(f"Loaded {checkpoint} ({entry['bytes'] / 2 ** 20:.0f} MB)", file=sys.stderr)
+            return entry
+
+    def _used_bytes(self):
+        return sum(entry["bytes"] for entry in self._entries.values())
+
+    def _make_room(self, incoming):
+        # Called with the lock held. Models in use stay loaded even if that exceeds the budget
+        unloaded = 0
+        for key in list(self._entries):
+            if self._used_bytes() + incoming <= self.max_bytes:
+                break
+            if self._entries[key]["users"] == 0:
+                self._unload(key, "over the memory budget")
+                unloaded += 1
+        return unloaded
+
+    def _unload(self, key, reason):
+        del self._entries[key]
+        self.unloads += 1
+        print(f"Unloaded {key[1]} ({reason})", file=sys.stderr)
+
+    def sweep(self):
+        # Unload the models nobody has used for idle_timeout seconds
+        now = time.monotonic()
+        with self._lock:
+            idle = [key for key, entry in self._entries.items()
+                    if entry["users"] == 0 and now - entry["last_used"] >= self.idle_timeout]
+            for key in idle:
+                self._unload(key, f"idle for {self.idle_timeout:g}s")
+        if idle:
+            release_memory()
+        return len(idle)
+
+    def _sweep_loop(self):
+        while not self._stopped.wait(min(60, max(1, self.idle_timeout / 4))):
+            self.sweep()
+
+    def close(self):
+        self._stopped.set()
+
+    def describe(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "budget_mb": round(self.max_bytes / 2 ** 20),
+                "used_mb": round(self._used_bytes() / 2 ** 20),
+                "loads": self.loads,
+                "unloads": self.unloads,
+                "models": [{"kind": kind, "checkpoint": checkpoint, "mb": round(entry["bytes"] / 2 ** 20),
+                            "in_use": entry["users"], "idle_seconds": round(now - entry["last_used"])}
+                           for (kind, checkpoint), entry in self._entries.items()],
+            }
+
+
+def onnx_dir_for(checkpoint):
+    return os.path.join(ONNX_EXPORT_DIR, checkpoint.strip("/").replace("/", "--"))
+
+
+def export_onnx(checkpoint, model_class_name, force=False):
+    # Export a BLIP checkpoint as three ONNX graphs: the vision encoder, the question encoder
+    # (VQA only) and the text decoder, which takes and returns past key/values so it can be
+    # run one token at a time. export.json is written last and marks a complete export
+    export_dir = onnx_dir_for(checkpoint)
+    if not force and os.path.exists(os.path.join(export_dir, "export.json")):
+        return export_dir
+
+    import shutil
+    import torch
+
+    processor, model = load_blip_checkpoint(checkpoint, model_class_name)
+    text_config = model.config.text_config
+    num_layers = text_config.num_hidden_layers
+    num_heads = text_config.num_attention_heads
+    head_dim = text_config.hidden_size // num_heads
+    vision_hidden_size = model.config.vision_config.hidden_size
+
+    class VisionEncoder(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.vision_model = model.vision_model
+
+        def forward(self, pixel_values):
+            return self.vision_model(pixel_values=pixel_values)[0]
+
+    class QuestionEncoder(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.text_encoder = model.text_encoder
+
+        def forward(self, input_ids, attention_mask, image_embeds):
+            image_attention_mask = torch.ones(image_embeds.shape[:-1], dtype=torch.long)
+            return self.text_encoder(input_ids=input_ids, attention_mask=attention_mask,
+                                     encoder_hidden_states=image_embeds,
+                                     encoder_attention_mask=image_attention_mask, return_dict=False)[0]
+
+    class Decoder(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.text_decoder = model.text_decoder
+
+        def forward(self, input_ids, attention_mask, encoder_hidden_states, encoder_attention_mask, *past):
+            past_key_values = tuple((past[i], past[i + 1]) for i in range(0, len(past), 2))
+            outputs = self.text_decoder(input_ids=input_ids, attention_mask=attention_mask,
+                                        encoder_hidden_states=encoder_hidden_states,
+                                        encoder_attention_mask=encoder_attention_mask,
+                                        past_key_values=past_key_values, use_cache=True, return_dict=True)
+            return (outputs.logits[:, -1, :],) + tuple(t for layer in outputs.past_key_values for t in layer)
+
+    temp_dir = export_dir + ".tmp"
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    os.makedirs(temp_dir)
+    processor.save_pretrained(temp_dir)
+
+    # Example inputs only fix the traced structure; every length below is a dynamic axis
+    batch_size = 2
+    pixel_values = processor(images=[Image.new('RGB', (64, 64))] * batch_size, return_tensors="pt")["pixel_values"]
+    with torch.no_grad():
+        image_embeds = model.vision_model(pixel_values=pixel_values)[0]
+    torch.onnx.export(
+        VisionEncoder(), (pixel_values,), os.path.join(temp_dir, "vision.onnx"),
+        input_names=["pixel_values"], output_names=["image_embeds"],
+        dynamic_axes={"pixel_values": {0: "batch"}, "image_embeds": {0: "batch"}},
+        opset_version=ONNX_OPSET, dynamo=False,
+    )
+
+    encoder_hidden_states = image_embeds
+    if model_class_name == "BlipForQuestionAnswering":
+        text_inputs = processor(text=["what is this?", "what color is the sky?"], padding=True, return_tensors="pt")
+        torch.onnx.export(
+            QuestionEncoder(), (text_inputs["input_ids"], text_inputs["attention_mask"], image_embeds),
+            os.path.join(temp_dir, "question_encoder.onnx"),
+            input_names=["input_ids", "attention_mask", "image_embeds"], output_names=["question_embeds"],
+            dynamic_axes={"input_ids": {0: "batch", 1: "question"}, "attention_mask": {0: "batch", 1: "question"},
+                          "image_embeds": {0: "batch"}, "question_embeds": {0: "batch", 1: "question"}},
+            opset_version=ONNX_OPSET, dynamo=False,
+        )
+        with torch.no_grad():
+            encoder_hidden_states = QuestionEncoder()(text_inputs["input_ids"], text_inputs["attention_mask"],
+                                                      image_embeds)
+        start_token_id = model.decoder_start_token_id
+    else:
+        start_token_id = text_config.bos_token_id
+
+    past_names = [f"past_{i}" for i in range(2 * num_layers)]
+    present_names = [f"present_{i}" for i in range(2 * num_layers)]
+    past = [torch.zeros(batch_size, num_heads, 3, head_dim) for _ in past_names]
+    dynamic_axes = {
+        "input_ids": {0: "batch", 1: "step"},
+        "attention_mask": {0: "batch", 1: "total"},
+        "encoder_hidden_states": {0: "batch", 1: "encoder"},
+        "encoder_attention_mask": {0: "batch", 1: "encoder"},
+        "logits": {0: "batch"},
+    }
+    dynamic_axes.update({name: {0: "batch", 2: "past"} for name in past_names + present_names})
+    torch.onnx.export(
+        Decoder(),
+        (torch.full((batch_size, 1), start_token_id), torch.ones(batch_size, 4, dtype=torch.long),
+         encoder_hidden_states, torch.ones(encoder_hidden_states.shape[:-1], dtype=torch.long), *past),
+        os.path.join(temp_dir, "decoder.onnx"),
+        input_names=["input_ids", "attention_mask", "encoder_hidden_states", "encoder_attention_mask"] + past_names,
+        output_names=["logits"] + present_names,
+        dynamic_axes=dynamic_axes, opset_version=ONNX_OPSET, dynamo=False,
+    )
+
+    with open(os.path.join(temp_dir, "export.json"), "w", encoding="utf-8") as f:
+        json.dump({
+            "checkpoint": checkpoint,
+            "model_class": model_class_name,
+            "revision": checkpoint_revision(model),
+            "num_layers": num_layers,
+            "num_heads": num_heads,
+            "head_dim": head_dim,
+            "vision_hidden_size": vision_hidden_size,
+            "start_token_id": start_token_id,
+            "sep_token_id": text_config.sep_token_id,
+            "pad_token_id": text_config.pad_token_id,
+        }, f, indent=2)
+    shutil.rmtree(export_dir, ignore_errors=True)
+    os.replace(temp_dir, export_dir)
+    return export_dir
+
+
+def image_processor_config(processor):
+    # The resize/rescale/normalize settings of a BlipProcessor or OnnxBlipProcessor as a plain dict
+    if isinstance(processor, OnnxBlipProcessor):
+        return processor.image_config
+    return processor.image_processor.to_dict()
+
+
+def preprocess_blip_image(image, image_config, out=None):
+    # BlipImageProcessor's resize, rescale and normalize steps in numpy, giving a (3, H, W)
+    # float32 array. Writing into out (e.g. a slot of a shared-memory batch) avoids a copy
+    import numpy as np
+
+    size = (image_config["size"]["width"], image_config["size"]["height"])
+    mean = np.array(image_config["image_mean"], dtype=np.float32)
+    std = np.array(image_config["image_std"], dtype=np.float32)
+    image = image.convert('RGB').resize(size, resample=image_config.get("resample", Image.BICUBIC))
+    pixels = np.asarray(image, dtype=np.float32) * np.float32(image_config["rescale_factor"])
+    normalized = ((pixels - mean) / std).transpose(2, 0, 1)
+    if out is None:
+        return normalized
+    out[...] = normalized
+    return out
+
+
+class OnnxBlipProcessor:
+    # Torch-free stand-in for BlipProcessor next to OnnxBlipModel: the resize/rescale/normalize
+    # steps of BlipImageProcessor from preprocessor_config.json and the fast tokenizer from tokenizer.json
+    def __init__(self, export_dir):
+        import tokenizers
+
+        with open(os.path.join(export_dir, "preprocessor_config.json"), encoding="utf-8") as f:
+            self.image_config = json.load(f)
+        with open(os.path.join(export_dir, "tokenizer_config.json"), encoding="utf-8") as f:
+            tokenizer_config = json.load(f)
+        self.clean_up_tokenization_spaces = tokenizer_config.get("clean_up_tokenization_spaces", True)
+        self.tokenizer = tokenizers.Tokenizer.from_file(os.path.join(export_dir, "tokenizer.json"))
+        self.tokenizer.no_truncation()
+        pad_token = tokenizer_config.get("pad_token", "[PAD]")
+        self.tokenizer.enable_padding(pad_id=self.tokenizer.token_to_id(pad_token), pad_token=pad_token)
+
+    def __call__(self, images=None, text=None, return_tensors="np", **kwargs):
+        import numpy as np
+
+        inputs = {}
+        if images is not None:
+            inputs["pixel_values"] = self.preprocess_images(images)
+        if text is not None:
+            encodings = self.tokenizer.encode_batch([text] if isinstance(text, str) else list(text))
+            inputs["input_ids"] = np.array([e.ids for e in encodings], dtype=np.int64)
+            inputs["attention_mask"] = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+        return inputs
+
+    def preprocess_images(self, images):
+        import numpy as np
+
+        images = images if isinstance(images, (list, tuple)) else [images]
+        return np.stack([preprocess_blip_image(image, self.image_config) for image in images])
+
+    def decode(self, token_ids, skip_special_tokens=True):
+        text = self.tokenizer.decode([int(t) for t in token_ids], skip_special_tokens=skip_special_tokens)
+        if self.clean_up_tokenization_spaces:
+            for old, new in TOKENIZATION_CLEANUP:
+                text = text.replace(old, new)
+        return text
+
+    def batch_decode(self, sequences, skip_special_tokens=True):
+        return [self.decode(token_ids, skip_special_tokens) for token_ids in sequences]
+
+
+class OnnxBlipModel:
+    # ONNX Runtime counterpart of BlipForConditionalGeneration / BlipForQuestionAnswering built
+    # from an export_onnx directory. Only numpy and onnxruntime are needed to run it, not torch
+    def __init__(self, export_dir, thread_budget=None):
+        import onnxruntime
+
+        with open(os.path.join(export_dir, "export.json"), encoding="utf-8") as f:
+            self.metadata = json.load(f)
+        self.name_or_path = self.metadata["checkpoint"]
+        self.export_dir = export_dir
+        self.inference_precision = "onnx"
+        options = onnxruntime.SessionOptions()
+        if thread_budget is not None and thread_budget.intra_op:
+            options.intra_op_num_threads = thread_budget.intra_op
+        if thread_budget is not None and thread_budget.inter_op:
+            options.inter_op_num_threads = thread_budget.inter_op
+
+        def session(name):
+            return onnxruntime.InferenceSession(os.path.join(export_dir, name), options,
+                                                providers=["CPUExecutionProvider"])
+
+        self.vision_session = session("vision.onnx")
+        self.decoder_session = session("decoder.onnx")
+        self.question_session = None
+        if self.metadata["model_class"] == "BlipForQuestionAnswering":
+            self.question_session = session("question_encoder.onnx")
+
+    def encode_image(self, pixel_values):
+        import numpy as np
+
+        return self.vision_session.run(None, {"pixel_values": pixel_values.astype(np.float32)})[0]
+
+    def encode_question(self, input_ids, attention_mask, image_embeds):
+        import numpy as np
+
+        return self.question_session.run(None, {
+            "input_ids": input_ids.astype(np.int64),
+            "attention_mask": attention_mask.astype(np.int64),
+            "image_embeds": image_embeds,
+        })[0]
+
+    def generate(self, encoder_hidden_states, encoder_attention_mask=None, max_new_tokens=MAX_NEW_TOKENS,
+                 streamer=None, cancelled=None):
+        # Greedy decoding with the key/value cache carried between steps, matching the default
+        # generate() of the torch models: finished rows are padded until every row hits [SEP].
+        # Like generate(), a streamer receives the start tokens first and then every new token.
+        # Setting the cancelled event raises GenerationCancelled before the next step
+        import numpy as np
+
+        metadata = self.metadata
+        batch_size = encoder_hidden_states.shape[0]
+        if encoder_attention_mask is None:
+            encoder_attention_mask = np.ones(encoder_hidden_states.shape[:2], dtype=np.int64)
+        input_ids = np.full((batch_size, 1), metadata["start_token_id"], dtype=np.int64)
+        empty_past = np.zeros((batch_size, metadata["num_heads"], 0, metadata["head_dim"]), dtype=np.float32)
+        past = [empty_past] * (2 * metadata["num_layers"])
+        finished = np.zeros(batch_size, dtype=bool)
+        generated = []
+        if streamer is not None:
+            streamer.put(input_ids)
+
+        for step in range(max_new_tokens):
+            if cancelled is not None and cancelled.is_set():
+                raise GenerationCancelled()
+            feed = {
+                "input_ids": input_ids,
+                "attention_mask": np.ones((batch_size, step + 1), dtype=np.int64),
+                "encoder_hidden_states": encoder_hidden_states,
+                "encoder_attention_mask": encoder_attention_mask.astype(np.int64),
+            }
+            feed.update((f"past_{i}", value) for i, value in enumerate(past))
+            logits, *past = self.decoder_session.run(None, feed)
+
+            next_tokens = np.where(finished, metadata["pad_token_id"], logits.argmax(axis=-1))
+            generated.append(next_tokens)
+            if streamer is not None:
+                streamer.put(next_tokens)
+            finished |= next_tokens == metadata["sep_token_id"]
+            if finished.all():
+                break
+            input_ids = next_tokens[:, None]
+
+        if streamer is not None:
+            streamer.end()
+        return np.stack(generated, axis=1) if generated else np.zeros((batch_size, 0), dtype=np.int64)
+
+
+class RequestTrace:
+    # Wall time per pipeline stage of one request. Spans nest and record their own time only,
+    # so a stage timed inside another (the vision encoder inside generate) is not counted twice
+    def __init__(self):
+        self.stages = {}
+        self._open = []
+
+    def begin(self):
+        self._open.append([time.perf_counter(), 0.0])
+
+    def end(self, name):
+        started, children = self._open.pop()
+        elapsed = time.perf_counter() - started
+        self.add(name, elapsed - children)
+        if self._open:
+            self._open[-1][1] += elapsed
+
+    @contextmanager
+    def span(self, name):
+        self.begin()
+        try:
+            yield
+        finally:
+            self.end(name)
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def total(self):
+        return sum(self.stages.values())
+
+    def summary(self):
+        names = [name for name in TRACE_STAGES if name in self.stages]
+        names += [name for name in self.stages if name not in TRACE_STAGES]
+        parts = [f"{name} {self.stages[name] * 1000:.0f}" for name in names]
+        return f"{self.total() * 1000:.0f} ms ({', '.join(parts)})"
+
+
+def span(trace, name):
+    # Tracing is optional everywhere; without a trace this costs one call
+    return trace.span(name) if trace is not None else nullcontext()
+
+
+@contextmanager
+def module_span(trace, module, name):
+    # Time every forward pass of a torch submodule as its own span, for stages that run inside
+    # a single generate() call
+    if trace is None:
+        yield
+        return
+    handles = [
+        module.register_forward_pre_hook(lambda *_: trace.begin()),
+        module.register_forward_hook(lambda *_: trace.end(name)),
+    ]
+    try:
+        yield
+    finally:
+        for handle in handles:
+            handle.remove()
+
+
+class StageMetrics:
+    # Aggregates request traces into per-stage latency histograms. Every trace can also be
+    # appended to a JSON Lines file, and the histograms are rewritten as a Prometheus text
+    # file after each request for node-exporter style scraping
+    def __init__(self, jsonl_path=None, prometheus_path=None, buckets=METRICS_BUCKETS):
+        self.jsonl_path = jsonl_path
+        self.prometheus_path = prometheus_path
+        self.buckets = buckets
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, kind, stage, seconds):
+        with self._lock:
+            histogram = self.histograms.setdefault((kind, stage), {
+                "count": 0, "sum": 0.0, "buckets": [0] * len(self.buckets)})
+            histogram["count"] += 1
+            histogram["sum"] += seconds
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram["buckets"][index] += 1
+
+    def record(self, kind, trace, **fields):
+        for stage, seconds in trace.stages.items():
+            self.observe(kind, stage, seconds)
+        self.observe(kind, "total", trace.total())
+        if self.jsonl_path:
+            line = dict(fields, time=time.time(), kind=kind, stages=trace.stages, total=trace.total())
+            with self._lock, open(self.jsonl_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(line) + "\n")
+        if self.prometheus_path:
+            self.write_prometheus(self.prometheus_path)
+
+    def prometheus_text(self):
+        lines = [
+            "# HELP image_caption_stage_seconds Time spent per pipeline stage of a request",
+            "# TYPE image_caption_stage_seconds histogram",
+        ]
+        with self._lock:
+            for (kind, stage), histogram in sorted(self.histograms.items()):
+                labels = f'kind="{kind}",stage="{stage}"'
+                for bound, count in zip(self.buckets, histogram["buckets"]):
+                    lines.append(f'image_caption_stage_seconds_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'image_caption_stage_seconds_bucket{{{labels},le="+Inf"}} {histogram["count"]}')
+                lines.append(f"image_caption_stage_seconds_sum{{{labels}}} {histogram['sum']}")
+                lines.append(f"image_caption_stage_seconds_count{{{labels}}} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        # Written beside the target and renamed, so a scraper never reads half a file
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp_path, path)
+
+
+def caption_images(processor, model, images, max_new_tokens=MAX_NEW_TOKENS, streamer=None, trace=None,
+                   cancelled=None):
+    # Caption a list of RGB images with a single batched generate call. The processor resizes
+    # every image to the same resolution, so the pixel batch stacks without extra padding.
+    # A streamer only works for a single image. Setting the cancelled event stops generation
+    # at the next decoding step with GenerationCancelled
+    with span(trace, "preprocess"):
+        return_tensors = "np" if isinstance(model, OnnxBlipModel) else "pt"
+        pixel_values = processor(images=images, return_tensors=return_tensors)["pixel_values"]
+    return caption_pixel_values(processor, model, pixel_values, max_new_tokens, streamer, trace, cancelled)
+
+
+def caption_pixel_values(processor, model, pixel_values, max_new_tokens=MAX_NEW_TOKENS, streamer=None, trace=None,
+                         cancelled=None):
+    # Caption already preprocessed images: a (batch, 3, H, W) numpy array or torch tensor
+    if isinstance(model, OnnxBlipModel):
+        with span(trace, "encode"):
+            image_embeds = model.encode_image(pixel_values)
+        with span(trace, "generate"):
+            caption_outputs = model.generate(image_embeds, max_new_tokens=max_new_tokens, streamer=streamer,
+                                             cancelled=cancelled)
+        with span(trace, "detokenize"):
+            return processor.batch_decode(caption_outputs, skip_special_tokens=True)
+
+    import torch
+
+    if not isinstance(pixel_values, torch.Tensor):
+        pixel_values = torch.from_numpy(pixel_values)  # Shares the array's memory
+    pixel_values = pixel_values.to(model.dtype)
+    with torch.inference_mode(), span(trace, "generate"), module_span(trace, model.vision_model, "encode"):
+        caption_outputs = model.generate(pixel_values=pixel_values, max_new_tokens=max_new_tokens, streamer=streamer,
+                                         stopping_criteria=cancellation_criteria(cancelled))
+    with span(trace, "detokenize"):
+        return processor.batch_decode(caption_outputs, skip_special_tokens=True)
+
+
+class GenerationCancelled(Exception):
+    pass
+
+
+def cancellation_criteria(cancelled):
+    # stopping_criteria for a torch generate() call that raises GenerationCancelled at the next
+    # decoding step once the cancelled event is set. Unlike a TokenStreamer it also works for
+    # batched calls
+    if cancelled is None:
+        return None
+    import torch
+    from transformers import StoppingCriteria, StoppingCriteriaList
+
+    class Cancellation(StoppingCriteria):
+        def __call__(self, input_ids, scores, **kwargs):
+            if cancelled.is_set():
+                raise GenerationCancelled()
+            return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+    return StoppingCriteriaList([Cancellation()])
+
+
+class TokenStreamer:
+    # Streamer for generate() of a single sequence: decodes the text produced so far after every
+    # token and hands it to on_text. generate() passes the prompt first, which is skipped.
+    # Also records time to first token and the decoding rate after it. Setting cancel_event
+    # aborts generate() at the next decoding step by raising GenerationCancelled
+    def __init__(self, processor, on_text, cancel_event=None):
+        self.processor = processor
+        self.on_text = on_text
+        self.cancel_event = cancel_event
+        self.token_ids = []
+        self.prompt_seen = False
+        self.started = time.perf_counter()
+        self.first_token_at = None
+        self.finished_at = None
+
+    def put(self, value):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise GenerationCancelled()
+        if not self.prompt_seen:
+            self.prompt_seen = True
+            return
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        self.token_ids.extend(int(token_id) for token_id in value.reshape(-1).tolist())
+        self.on_text(self.processor.decode(self.token_ids, skip_special_tokens=True))
+
+    def end(self):
+        self.finished_at = time.perf_counter()
+
+    def stats(self):
+        finished_at = self.finished_at or time.perf_counter()
+        first_token_at = self.first_token_at or finished_at
+        decode_seconds = finished_at - first_token_at
+        return {
+            "time_to_first_token": first_token_at - self.started,
+            "tokens": len(self.token_ids),
+            "tokens_per_second": (len(self.token_ids) - 1) / decode_seconds if decode_seconds > 0 else 0.0,
+        }
+
+
+class IngestedImage:
+    # An image decoded once at reduced size, shared by the display and the models
+    def __init__(self, path, image_hash, image, original_size):
+        self.path = path
+        self.image_hash = image_hash
+        self.image = image
+        self.original_size = original_size
+
+
+def ingest_image_bytes(data, path=None, max_side=INGEST_MAX_SIDE, max_pixels=INGEST_MAX_PIXELS, image_hash=None):
+    # Decode encoded image bytes into an RGB image no larger than max_side. JPEGs are decoded
+    # at a reduced scale by the decoder itself (draft mode), so a 50-megapixel photo never
+    # exists at full size in memory; other formats are decoded and then downscaled
+    try:
+        image = Image.open(io.BytesIO(data))
+    except UnidentifiedImageError:
+        # PIL would name the in-memory buffer; the path is what the user needs to see
+        raise UnidentifiedImageError(f"cannot identify image file {path or '(upload)'!r}") from None
+    original_size = image.size
+    if original_size[0] * original_size[1] > max_pixels:
+        raise ValueError(f"Image is too large ({original_size[0]}x{original_size[1]})")
+    scale = min(1.0, max_side / max(original_size))
+    target_size = (max(1, round(original_size[0] * scale)), max(1, round(original_size[1] * scale)))
+    image.draft("RGB", target_size)
+    image = image.convert('RGB')
+    if image.size != target_size:
+        image = image.resize(target_size, Image.BICUBIC, reducing_gap=2.0)
+    return IngestedImage(path, image_hash or hashlib.sha256(data).hexdigest(), image, original_size)
+
+
+def ingest_image(path, max_side=INGEST_MAX_SIDE, max_pixels=INGEST_MAX_PIXELS):
+    # The file is read once for both its content hash and the decode
+    with open(path, "rb") as f:
+        data = f.read()
+    return ingest_image_bytes(data, path, max_side, max_pixels)
+
+
+def hash_image_file(path):
+    # Content hash of the image file, so renamed or re-uploaded copies share cache entries
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def perceptual_hash(image):
+    # 64-bit difference hash: one bit per horizontally adjacent pixel pair of a 9x8 grayscale
+    # thumbnail. Re-encoding, resizing and small edits change only a few bits
+    pixels = image.convert("L").resize((9, 8), Image.BOX).tobytes()  # One byte per pixel, row by row
+    value = 0
+    for row in range(8):
+        for column in range(8):
+            index = row * 9 + column
+            value = (value << 1) | (pixels[index + 1] > pixels[index])
+    return value
+
+
+def encode_image(processor, model, image, trace=None):
+    # Run only the vision encoder and return its patch embeddings
+    if isinstance(model, OnnxBlipModel):
+        with span(trace, "preprocess"):
+            pixel_values = processor(images=image, return_tensors="np")["pixel_values"]
+        with span(trace, "encode"):
+            return model.encode_image(pixel_values)
+
+    import torch
+
+    with span(trace, "preprocess"):
+        pixel_values = processor(images=image, return_tensors="pt")["pixel_values"].to(model.dtype)
+    with torch.inference_mode(), span(trace, "encode"):
+        return model.vision_model(pixel_values=pixel_values)[0]
+
+
+def answer_questions(processor, model, image_embeds, questions, max_new_tokens=MAX_NEW_TOKENS, streamer=None,
+                     trace=None, cancelled=None):
+    # Same steps as BlipForQuestionAnswering.generate after its vision pass, for a batch of
+    # questions. image_embeds holds one row per question, or a single row shared by all of them.
+    # Padded question tokens are masked out of the decoder's cross-attention, so batched answers
+    # match the ones asked one at a time
+    if isinstance(model, OnnxBlipModel):
+        import numpy as np
+
+        with span(trace, "preprocess"):
+            text_inputs = processor(text=questions, return_tensors="np")
+        if image_embeds.shape[0] != len(questions):
+            image_embeds = np.repeat(image_embeds, len(questions), axis=0)
+        with span(trace, "encode"):
+            question_embeds = model.encode_question(text_inputs["input_ids"], text_inputs["attention_mask"],
+                                                    image_embeds)
+        with span(trace, "generate"):
+            qa_outputs = model.generate(question_embeds, text_inputs["attention_mask"],
+                                        max_new_tokens=max_new_tokens, streamer=streamer, cancelled=cancelled)
+        with span(trace, "detokenize"):
+            return processor.batch_decode(qa_outputs, skip_special_tokens=True)
+
+    import torch
+
+    with span(trace, "preprocess"):
+        text_inputs = processor(text=questions, padding=True, return_tensors="pt")
+    if image_embeds.shape[0] != len(questions):
+        image_embeds = image_embeds.expand(len(questions), -1, -1)
+    with torch.inference_mode():
+        with span(trace, "encode"):
+            image_attention_mask = torch.ones(image_embeds.size()[:-1], dtype=torch.long)
+            question_embeds = model.text_encoder(
+                input_ids=text_inputs["input_ids"],
+                attention_mask=text_inputs["attention_mask"],
+                encoder_hidden_states=image_embeds,
+                encoder_attention_mask=image_attention_mask,
+                return_dict=False,
+            )[0]
+        bos_ids = torch.full((question_embeds.size(0), 1), fill_value=model.decoder_start_token_id)
+        with span(trace, "generate"):
+            qa_outputs = model.text_decoder.generate(
+                input_ids=bos_ids,
+                eos_token_id=model.config.text_config.sep_token_id,
+                pad_token_id=model.config.text_config.pad_token_id,
+                encoder_hidden_states=question_embeds,
+                encoder_attention_mask=text_inputs["attention_mask"],
+                max_new_tokens=max_new_tokens,
+                streamer=streamer,
+                stopping_criteria=cancellation_criteria(cancelled),
+            )
+    with span(trace, "detokenize"):
+        return processor.batch_decode(qa_outputs, skip_special_tokens=True)
+
+
+def answer_from_image_embeds(processor, model, image_embeds, question, max_new_tokens=MAX_NEW_TOKENS,
+                             streamer=None):
+    # Answer one question from a (possibly cached) image embedding, so it only pays for the
+    # text encoder and the answer decoder
+    return answer_questions(processor, model, image_embeds, [question], max_new_tokens, streamer)[0]
+
+
+def answer_batch(processor, model, items, trace=None):
+    # Answers of (image, question) pairs in one batch. Questions about the same image object
+    # (one multi-question request) share one vision pass
+    images = {}
+    rows = [images.setdefault(id(image), len(images)) for image, _ in items]
+    unique_images = list({id(image): image for image, _ in items}.values())
+    image_embeds = encode_image(processor, model, unique_images, trace)[rows]
+    return answer_questions(processor, model, image_embeds, [question for _, question in items], trace=trace)
+
+
+def split_questions(text):
+    # One question per non-empty line of the question box
+    return [line.strip() for line in text.splitlines() if line.strip()]
+
+
+def format_answers(questions, answers):
+    # Aligned question/answer pairs for the answer box; a single question shows just its answer
+    if len(questions) == 1:
+        return answers[0]
+    return "\n\n".join(f"Q: {question}\nA: {answer}" for question, answer in zip(questions, answers))
+
+
+def answer_image_questions(processor, model, image_path, questions, embedding_cache=None, result_cache=None,
+                           max_new_tokens=MAX_NEW_TOKENS, streamer=None, ingested=None, trace=None, cancelled=None):
+    # Answer every question about one image. Cached answers are reused, the image is encoded
+    # once and the remaining questions are answered by a single batched generate call.
+    # A streamer is only used when a single question is left to answer; cancelled stops the
+    # batched call too. An already decoded IngestedImage of image_path can be passed to avoid
+    # reading the file again
+    image_hash = ingested.image_hash if ingested is not None else hash_image_file(image_path)
+    params = {"max_new_tokens": max_new_tokens, "precision": model_precision(model)}
+    answers = [None] * len(questions)
+    if result_cache is not None:
+        for index, question in enumerate(questions):
+            answers[index] = result_cache.get("answer", image_hash, model.name_or_path, question, params)
+    missing = [index for index, answer in enumerate(answers) if answer is None]
+    if not missing:
+        return answers
+
+    # The image does not change between questions, so its vision-encoder output is reused
+    cache_key = (image_hash, model.name_or_path, model_precision(model))
+    image_embeds = embedding_cache.get(cache_key) if embedding_cache is not None else None
+    if image_embeds is None:
+        if ingested is None:
+            with span(trace, "decode"):
+                ingested = ingest_image(image_path)
+        image_embeds = encode_image(processor, model, ingested.image, trace)
+        if embedding_cache is not None:
+            embedding_cache.put(cache_key, image_embeds)
+
+    new_answers = answer_questions(processor, model, image_embeds, [questions[index] for index in missing],
+                                   max_new_tokens, streamer if len(missing) == 1 else None, trace, cancelled)
+    for index, answer in zip(missing, new_answers):
+        answers[index] = answer
+        if result_cache is not None:
+            result_cache.put("answer", image_hash, model.name_or_path, answer, questions[index], params)
+    return answers
+
+
+def is_image_sequence(path):
+    # A folder of numbered frames, or an animated GIF (or APNG / WebP) file
+    if os.path.isdir(path):
+        return True
+    try:
+        with Image.open(path) as image:
+            return getattr(image, "is_animated", False)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return False
+
+
+def sequence_frame_paths(folder):
+    # Image files of a frame folder in numeric order, so frame10 follows frame9
+    names = [name for name in os.listdir(folder) if name.lower().endswith(IMAGE_EXTENSIONS)]
+    names.sort(key=lambda name: [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", name)])
+    return [os.path.join(folder, name) for name in names]
+
+
+def iter_sequence_frames(path, fps=SEQUENCE_FOLDER_FPS, max_side=INGEST_MAX_SIDE, max_pixels=INGEST_MAX_PIXELS):
+    # (start, duration, RGB frame no larger than max_side) for every frame of an animated image, or
+    # of a frame folder played at fps. Frames are decoded one at a time and not kept
+    if os.path.isdir(path):
+        for index, frame_path in enumerate(sequence_frame_paths(path)):
+            yield index / fps, 1 / fps, ingest_image(frame_path, max_side, max_pixels).image
+        return
+    with Image.open(path) as image:
+        if image.width * image.height > max_pixels:
+            raise ValueError(f"Image is too large ({image.width}x{image.height})")
+        start_ms = 0
+        for frame in ImageSequence.Iterator(image):
+            # Viewers show frames without a delay for 100 ms
+            duration_ms = int(frame.info.get("duration") or 100)
+            rgb = frame.convert("RGB")
+            if max(rgb.size) > max_side:
+                rgb.thumbnail((max_side, max_side), Image.BICUBIC)
+            yield start_ms / 1000, duration_ms / 1000, rgb
+            start_ms += duration_ms
+
+
+def frame_signature(image):
+    return image.convert("L").resize(SEQUENCE_SIGNATURE_SIZE, Image.BOX)
+
+
+def frame_difference(signature, other):
+    # Mean absolute difference of two frame signatures, from 0 (identical) to 1
+    return ImageStat.Stat(ImageChops.difference(signature, other)).mean[0] / 255
+
+
+def caption_track_params(precision, change_threshold=SEQUENCE_CHANGE_THRESHOLD, fps=SEQUENCE_FOLDER_FPS,
+                         max_new_tokens=MAX_NEW_TOKENS):
+    # Generation parameters a cached caption track is keyed by
+    return {"max_new_tokens": max_new_tokens, "precision": precision, "change_threshold": change_threshold,
+            "fps": fps}
+
+
+def caption_sequence(processor, model, path, result_cache=None, change_threshold=SEQUENCE_CHANGE_THRESHOLD,
+                     fps=SEQUENCE_FOLDER_FPS, batch_size=8, max_new_tokens=MAX_NEW_TOKENS, on_progress=None,
+                     cancelled=None, trace=None):
+    # Caption track of an image sequence. Only keyframes are captioned: the first frame and every
+    # frame differing by at least change_threshold from the last keyframe. Keyframes are captioned
+    # batch_size at a time. Returns {"frames", "keyframes", "duration", "track"}, the track being
+    # {"start", "end", "frame", "caption"} segments with consecutive equal captions merged.
+    # on_progress gets the track so far after every batch
+    image_hash = None
+    params = caption_track_params(model_precision(model), change_threshold, fps, max_new_tokens)
+    if result_cache is not None and not os.path.isdir(path):
+        image_hash = hash_image_file(path)
+        cached = result_cache.get("caption_track", image_hash, model.name_or_path, params=params)
+        if cached is not None:
+            return json.loads(cached)
+
+    track = []
+    pending = []
+    keyframes = 0
+    frames = 0
+    end = 0.0
+    last_signature = None
+
+    def caption_pending():
+        captions = caption_images(processor, model, [image for _, _, image in pending], max_new_tokens, trace=trace,
+                                  cancelled=cancelled)
+        for (index, start, _), caption in zip(pending, captions):
+            if not track or track[-1]["caption"] != caption:
+                track.append({"start": start, "end": None, "frame": index, "caption": caption})
+        pending.clear()
+        if on_progress is not None:
+            on_progress(track)
+
+    frame_iter = iter_sequence_frames(path, fps)
+    while True:
+        with span(trace, "decode"):
+            item = next(frame_iter, None)
+            if item is None:
+                break
+            start, duration, image = item
+            signature = frame_signature(image)
+            changed = last_signature is None or frame_difference(signature, last_signature) >= change_threshold
+        if cancelled is not None and cancelled.is_set():
+            raise GenerationCancelled()
+        if changed:
+            last_signature = signature
+            pending.append((frames, start, image))
+            keyframes += 1
+            if len(pending) == batch_size:
+                caption_pending()
+        frames += 1
+        end = start + duration
+    if pending:
+        caption_pending()
+
+    for segment, following in zip(track, track[1:] + [None]):
+        segment["end"] = following["start"] if following is not None else end
+    result = {"frames": frames, "keyframes": keyframes, "duration": end, "track": track}
+    if image_hash is not None:
+        result_cache.put("caption_track", image_hash, model.name_or_path, json.dumps(result), params=params)
+    return result
+
+
+def format_caption_track(track):
+    return "\n".join(f"{segment['start']:.1f}s: {segment['caption']}" for segment in track)
+
+
+def caption_track_vtt(track):
+    def timestamp(seconds):
+        minutes, seconds = divmod(seconds, 60)
+        hours, minutes = divmod(int(minutes), 60)
+        return f"{hours:02d}:{minutes:02d}:{seconds:06.3f}"
+
+    cues = [f"{timestamp(segment['start'])} --> {timestamp(segment['end'])}\n{segment['caption']}"
+            for segment in track]
+    return "WEBVTT\n\n" + "\n\n".join(cues) + "\n"
+
+
+def tile_offsets(length, tile_size, overlap):
+    # Start offsets of tiles along one side, spread evenly so the last tile ends at the edge. A side
+    # at most one tile plus its overlap long is not split; its single tile spans the whole side
+    if length <= tile_size * (1 + overlap):
+        return [0]
+    count = math.ceil((length - tile_size) / (tile_size * (1 - overlap))) + 1
+    return [round(index * (length - tile_size) / (count - 1)) for index in range(count)]
+
+
+def tile_boxes(width, height, tile_size=TILE_SIZE, overlap=TILE_OVERLAP, max_tiles=TILE_MAX_COUNT):
+    # (left, top, right, bottom) boxes of overlapping tiles covering a width x height image, and
+    # the tile size used: tiles grow until max_tiles of them cover the image. An image that fits
+    # in a single tile gets no tiles, since the global view already shows it whole
+    while True:
+        xs = tile_offsets(width, tile_size, overlap)
+        ys = tile_offsets(height, tile_size, overlap)
+        if len(xs) * len(ys) <= max_tiles:
+            break
+        tile_size = math.ceil(tile_size * 1.25)
+    if len(xs) * len(ys) == 1:
+        return [], tile_size
+    tile_width = tile_size if len(xs) > 1 else width
+    tile_height = tile_size if len(ys) > 1 else height
+    return [(x, y, x + tile_width, y + tile_height) for y in ys for x in xs], tile_size
+
+
+def tiled_caption_params(precision, tile_size=TILE_SIZE, overlap=TILE_OVERLAP, max_tiles=TILE_MAX_COUNT,
+                         max_new_tokens=MAX_NEW_TOKENS):
+    # Generation parameters a cached tiled caption is keyed by
+    return {"max_new_tokens": max_new_tokens, "precision": precision, "tile_size": tile_size, "overlap": overlap,
+            "max_tiles": max_tiles}
+
+
+def caption_tiles(processor, model, path, result_cache=None, tile_size=TILE_SIZE, overlap=TILE_OVERLAP,
+                  max_tiles=TILE_MAX_COUNT, max_new_tokens=MAX_NEW_TOKENS, trace=None, cancelled=None, data=None,
+                  image_hash=None):
+    # Caption of a whole image plus captions of overlapping regions of it, for detail that is lost
+    # when a large scan or panorama is squeezed into the model's 384x384 input. The global view
+    # and all tiles are captioned by one batched generate call. The image is decoded only as
+    # large as the tiles need. Returns {"width", "height", "caption", "tile_size", "regions":
+    # [{"box": [left, top, right, bottom], "caption"}]}, boxes in pixels of the original image.
+    # A caller that already read the file can pass its bytes and their hash
+    if data is None:
+        with open(path, "rb") as f:
+            data = f.read()
+    image_hash = image_hash or hashlib.sha256(data).hexdigest()
+    params = tiled_caption_params(model_precision(model), tile_size, overlap, max_tiles, max_new_tokens)
+    if result_cache is not None:
+        cached = result_cache.get("caption_tiles", image_hash, model.name_or_path, params=params)
+        if cached is not None:
+            return json.loads(cached)
+
+    with span(trace, "decode"):
+        try:
+            width, height = Image.open(io.BytesIO(data)).size  # Reads the header only
+        except UnidentifiedImageError:
+            raise UnidentifiedImageError(f"cannot identify image file {path!r}") from None
+        boxes, used_tile_size = tile_boxes(width, height, tile_size, overlap, max_tiles)
+        image_config = image_processor_config(processor)
+        input_side = max(image_config["size"]["height"], image_config["size"]["width"])
+        # A tile is shown to the model at input_side pixels, so decoding finer would be wasted
+        max_side = max(input_side, math.ceil(max(width, height) * input_side / used_tile_size))
+        image = ingest_image_bytes(data, path, max_side, image_hash=image_hash).image
+        scale = image.width / width
+        tiles = [image.crop(tuple(round(value * scale) for value in box)) for box in boxes]
+    captions = caption_images(processor, model, [image] + tiles, max_new_tokens, trace=trace, cancelled=cancelled)
+
+    result = {"width": width, "height": height, "caption": captions[0], "tile_size": used_tile_size,
+              "regions": [{"box": list(box), "caption": caption} for box, caption in zip(boxes, captions[1:])]}
+    if result_cache is not None:
+        result_cache.put("caption_tiles", image_hash, model.name_or_path, json.dumps(result), params=params)
+    return result
+
+
+def tiled_caption_text(result):
+    # The distinct captions of a tiled result, global caption first, as indexed for search
+    return "\n".join(dict.fromkeys([result["caption"]] + [region["caption"] for region in result["regions"]]))
+
+
+def format_tiled_caption(result):
+    regions = [f"({region['box'][0]}, {region['box'][1]})-({region['box'][2]}, {region['box'][3]}): "
+               f"{region['caption']}" for region in result["regions"]]
+    return "\n".join([result["caption"]] + ([""] + regions if regions else []))
+
+
+class ImageEmbeddingCache:
+    # LRU cache of vision-encoder outputs keyed by (image content hash, model id) and bounded
+    # by the total size of the cached tensors. Shared between QA threads, hence the lock
+    def __init__(self, max_bytes=EMBEDDING_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            embeds = self._entries.get(key)
+            if embeds is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return embeds
+
+    def put(self, key, embeds):
+        size = embeds.nbytes
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key).nbytes
+            self._entries[key] = embeds
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= evicted.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+            }
+
+
+def checkpoint_revision(model):
+    # Hub downloads record the commit they came from; local checkpoints fall back to their mtime
+    if isinstance(model, OnnxBlipModel):
+        return model.metadata["revision"]
+    revision = getattr(model.config, "_commit_hash", None)
+    if revision:
+        return revision
+    if os.path.isdir(model.name_or_path):
+        return str(os.path.getmtime(model.name_or_path))
+    return "unknown"
+
+
+class ResultCache:
+    # Persistent SQLite store of generated captions and answers. Entries are keyed by image
+    # content hash, checkpoint, normalized question and generation parameters, capped at
+    # max_entries with least-recently-used eviction, and dropped when a checkpoint's revision changes.
+    # Several processes can share the file, so writes are kept off the hot path: the cap is only
+    # enforced every prune_interval inserts, and a hit only records its use once the recorded
+    # last use is older than touch_interval
+    def __init__(self, path=RESULT_CACHE_PATH, max_entries=RESULT_CACHE_MAX_ENTRIES,
+                 prune_interval=RESULT_CACHE_PRUNE_INTERVAL, touch_interval=RESULT_CACHE_TOUCH_INTERVAL):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.max_entries = max_entries
+        self.prune_interval = prune_interval
+        self.touch_interval = touch_interval
+        self._inserts = 0
+        self._synced = set()  # Checkpoints whose revision was checked before their first lookup
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, kind TEXT, image_hash TEXT, checkpoint TEXT, "
+                "question TEXT, params TEXT, result TEXT, last_used REAL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS results_checkpoint ON results (checkpoint)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS checkpoints (checkpoint TEXT PRIMARY KEY, revision TEXT)")
+
+    @staticmethod
+    def normalize_question(question):
+        return " ".join(question.lower().split())
+
+    def _key(self, kind, image_hash, checkpoint, question, params):
+        payload = json.dumps([kind, image_hash, checkpoint, self.normalize_question(question), params],
+                             sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, kind, image_hash, checkpoint, question="", params=None):
+        # Hits are served before any model is loaded, so the first lookup of a checkpoint checks the
+        # revision from_pretrained would load and drops the results of an older one
+        if checkpoint not in self._synced:
+            revision = checkpoint_source_revision(checkpoint)
+            if revision is not None:
+                self.sync_checkpoint(checkpoint, revision)
+            self._synced.add(checkpoint)
+        key = self._key(kind, image_hash, checkpoint, question, params or {})
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT result, last_used FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            if now - row[1] >= self.touch_interval:
+                self._conn.execute("UPDATE results SET last_used = ? WHERE key = ?", (now, key))
+            return row[0]
+
+    def put(self, kind, image_hash, checkpoint, result, question="", params=None):
+        params = params or {}
+        key = self._key(kind, image_hash, checkpoint, question, params)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, kind, image_hash, checkpoint, self.normalize_question(question),
+                 json.dumps(params, sort_keys=True), result, time.time()),
+            )
+            self._inserts += 1
+            if self._inserts % self.prune_interval:
+                return
+            count = self._conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM results WHERE key IN "
+                    "(SELECT key FROM results ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+
+    def sync_checkpoint(self, checkpoint, revision):
+        # Called once a model is loaded and before the first lookup of a checkpoint: results from an
+        # older revision of it are stale
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT revision FROM checkpoints WHERE checkpoint = ?",
+                                     (checkpoint,)).fetchone()
+            if row is not None and row[0] != revision:
+                self._conn.execute("DELETE FROM results WHERE checkpoint = ?", (checkpoint,))
+            self._conn.execute("INSERT OR REPLACE INTO checkpoints VALUES (?, ?)", (checkpoint, revision))
+
+    def invalidate(self, checkpoint=None):
+        with self._lock, self._conn:
+            if checkpoint is None:
+                removed = self._conn.execute("DELETE FROM results").rowcount
+                self._conn.execute("DELETE FROM checkpoints")
+            else:
+                removed = self._conn.execute("DELETE FROM results WHERE checkpoint = ?", (checkpoint,)).rowcount
+                self._conn.execute("DELETE FROM checkpoints WHERE checkpoint = ?", (checkpoint,))
+        return removed
+
+
+class NearDuplicateIndex:
+    # Perceptual hashes of captioned images, searched by Hamming distance with multi-index hashing:
+    # the hash is split into four 16-bit bands, each indexed together with the full hash. Two hashes
+    # within distance t agree on at least one band up to t // 4 bits, so a lookup reads only the
+    # index entries of those band values. Up to a threshold of 3 that is one exact value per band
+    BANDS = 4
+    BAND_BITS = 16
+
+    def __init__(self, path=RESULT_CACHE_PATH, threshold=NEAR_DUPLICATE_THRESHOLD):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.threshold = threshold
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        bands = [f"band{band}" for band in range(self.BANDS)]
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS perceptual_hashes ("
+                f"image_hash TEXT PRIMARY KEY, phash INTEGER, {', '.join(f'{band} INTEGER' for band in bands)})"
+            )
+            # (band, phash) covers the candidate scan, so it never touches the table itself
+            for band in bands:
+                self._conn.execute(f"CREATE INDEX IF NOT EXISTS perceptual_hashes_{band} "
+                                   f"ON perceptual_hashes ({band}, phash)")
+
+    def _bands(self, phash):
+        mask = (1 << self.BAND_BITS) - 1
+        return [(phash >> (band * self.BAND_BITS)) & mask for band in range(self.BANDS)]
+
+    def _band_values(self, value, radius):
+        values = [value]
+        for count in range(1, radius + 1):
+            for bits in itertools.combinations(range(self.BAND_BITS), count):
+                flipped = value
+                for bit in bits:
+                    flipped ^= 1 << bit
+                values.append(flipped)
+        return values
+
+    def add(self, image_hash, phash):
+        # SQLite integers are signed 64-bit
+        signed = phash - (1 << 64) if phash >= 1 << 63 else phash
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO perceptual_hashes VALUES (?, ?, ?, ?, ?, ?)",
+                               (image_hash, signed, *self._bands(phash)))
+
+    def find(self, phash, threshold=None):
+        # (distance, image_hash) of the indexed images within threshold bits, closest first
+        threshold = self.threshold if threshold is None else threshold
+        if threshold < 0:
+            return []
+        radius = threshold // self.BANDS
+        distances = {}
+        with self._lock:
+            for band, value in enumerate(self._bands(phash)):
+                values = self._band_values(value, radius)
+                rows = self._conn.execute(
+                    f"SELECT rowid, phash FROM perceptual_hashes WHERE band{band} IN ({', '.join('?' * len(values))})",
+                    values)
+                for rowid, candidate in rows:
+                    distance = bin((candidate & 0xFFFFFFFFFFFFFFFF) ^ phash).count("1")
+                    if distance <= threshold:
+                        distances[rowid] = distance
+            if not distances:
+                return []
+            rows = self._conn.execute(
+                f"SELECT rowid, image_hash FROM perceptual_hashes WHERE rowid IN ({', '.join('?' * len(distances))})",
+                list(distances)).fetchall()
+        return sorted((distances[rowid], image_hash) for rowid, image_hash in rows)
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM perceptual_hashes").fetchone()[0]
+
+
+def reuse_near_duplicate_caption(result_cache, near_duplicates, phash, checkpoint, params):
+    # Caption of the closest indexed near-duplicate that has one for this checkpoint and these
+    # parameters, with where it came from: (caption, {"image_hash", "distance"}) or (None, None)
+    if near_duplicates is None:
+        return None, None
+    for distance, image_hash in near_duplicates.find(phash):
+        caption = result_cache.get("caption", image_hash, checkpoint, params=params)
+        if caption is not None:
+            return caption, {"image_hash": image_hash, "distance": distance}
+    return None, None
+
+
+def fts_query(text):
+    # FTS5 query matching every word of text, the last one as a prefix so results follow typing.
+    # Words are quoted, so FTS5 operators and punctuation in the input are taken literally
+    words = re.findall(r"\w+", text.lower())
+    if not words:
+        return None
+    return " ".join(f'"{word}"' for word in words) + "*"
+
+
+class SearchIndex:
+    # Full-text index of the captions and answers generated for image files, kept in SQLite FTS5.
+    # search_entries holds one row per (kind, path, question), the latest result replacing older
+    # ones; search_fts indexes its question and text columns (porter-stemmed) without storing a
+    # second copy and is kept in sync by triggers. JSONL output of caption-batch, ask and
+    # caption-sequence is ingested incrementally: the byte offset read so far is kept per file
+    def __init__(self, path=SEARCH_INDEX_PATH):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS search_entries ("
+                "id INTEGER PRIMARY KEY, kind TEXT, path TEXT, image_hash TEXT, question TEXT, text TEXT, "
+                "added REAL, UNIQUE (kind, path, question))"
+            )
+            self._conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5("
+                "question, text, content='search_entries', content_rowid='id', tokenize='porter unicode61')"
+            )
+            self._conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS search_entries_insert AFTER INSERT ON search_entries BEGIN "
+                "INSERT INTO search_fts (rowid, question, text) VALUES (new.id, new.question, new.text); END"
+            )
+            self._conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS search_entries_delete AFTER DELETE ON search_entries BEGIN "
+                "INSERT INTO search_fts (search_fts, rowid, question, text) "
+                "VALUES ('delete', old.id, old.question, old.text); END"
+            )
+            self._conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS search_entries_update AFTER UPDATE ON search_entries BEGIN "
+                "INSERT INTO search_fts (search_fts, rowid, question, text) "
+                "VALUES ('delete', old.id, old.question, old.text); "
+                "INSERT INTO search_fts (rowid, question, text) VALUES (new.id, new.question, new.text); END"
+            )
+            self._conn.execute("CREATE TABLE IF NOT EXISTS ingested_files (path TEXT PRIMARY KEY, offset INTEGER)")
+
+    def _upsert(self, entries):
+        # Unchanged results are skipped, so re-ingesting a file does not churn the full-text index
+        now = time.time()
+        self._conn.executemany(
+            "INSERT INTO search_entries (kind, path, image_hash, question, text, added) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (kind, path, question) DO UPDATE SET "
+            "image_hash = COALESCE(excluded.image_hash, image_hash), text = excluded.text, added = excluded.added "
+            "WHERE text IS NOT excluded.text OR image_hash IS NOT COALESCE(excluded.image_hash, image_hash)",
+            [(kind, os.path.abspath(path), image_hash, ResultCache.normalize_question(question), text, now)
+             for kind, path, image_hash, question, text in entries])
+
+    def add(self, kind, path, text, question="", image_hash=None):
+        with self._lock, self._conn:
+            self._upsert([(kind, path, image_hash, question, text)])
+
+    def add_answers(self, path, questions, answers, image_hash=None):
+        with self._lock, self._conn:
+            self._upsert([("answer", path, image_hash, question, answer)
+                          for question, answer in zip(questions, answers)])
+
+    @staticmethod
+    def entries_from_record(record):
+        # (kind, path, image_hash, question, text) of one JSONL line; error lines have none
+        path = record.get("path")
+        if path is None or "error" in record:
+            return []
+        image_hash = record.get("image_hash")
+        if "regions" in record:
+            return [("caption_tiles", path, image_hash, "", tiled_caption_text(record))]
+        if "caption" in record:
+            return [("caption", path, image_hash, "", record["caption"])]
+        if "answer" in record:
+            return [("answer", path, image_hash, record["question"], record["answer"])]
+        if "track" in record:
+            captions = list(dict.fromkeys(entry["caption"] for entry in record["track"]))
+            return [("caption_track", path, image_hash, "", "\n".join(captions))]
+        return []
+
+    def ingest_jsonl(self, path, chunk_lines=10000):
+        # Index the lines appended to a JSONL output since the last call. Only complete lines are
+        # read, so a file still being written is picked up where it was left next time. A file
+        # that became shorter was rewritten and is read from the start. Returns the lines read
+        path = os.path.abspath(path)
+        with self._lock:
+            row = self._conn.execute("SELECT offset FROM ingested_files WHERE path = ?", (path,)).fetchone()
+        offset = row[0] if row is not None else 0
+        if offset > os.path.getsize(path):
+            offset = 0
+
+        lines = 0
+        with open(path, "rb") as f:
+            f.seek(offset)
+            while True:
+                entries = []
+                consumed = 0
+                for line in itertools.islice(f, chunk_lines):
+                    if not line.endswith(b"\n"):
+                        break
+                    consumed += len(line)
+                    lines += 1
+                    try:
+                        entries.extend(self.entries_from_record(json.loads(line)))
+                    except (ValueError, KeyError, TypeError, AttributeError):
+                        continue  # Not an output line of ours
+                if not consumed:
+                    break
+                offset += consumed
+                # Each chunk is committed with its offset, so an interrupted ingest resumes cleanly
+                with self._lock, self._conn:
+                    self._upsert(entries)
+                    self._conn.execute("INSERT OR REPLACE INTO ingested_files VALUES (?, ?)", (path, offset))
+                f.seek(offset)
+        return lines
+
+    def search(self, query, limit=SEARCH_RESULT_LIMIT):
+        # Images whose captions or answers match every word of query, best bm25 match first:
+        # [{"path", "image_hash", "score", "matches": [{"kind", "question", "text"}]}]. Ranking
+        # costs about a microsecond per matching entry, so a query matching more than
+        # SEARCH_RANKED_MATCHES entries (a word in most captions) returns the most recently
+        # indexed images instead, with a score of None
+        match = fts_query(query)
+        if match is None:
+            return []
+        with self._lock:
+            matching = self._conn.execute("SELECT COUNT(*) FROM search_fts WHERE search_fts MATCH ?",
+                                          (match,)).fetchone()[0]
+            if matching <= SEARCH_RANKED_MATCHES:
+                # Grouping and ranking run inside SQLite
+                grouped = [(path, score, [int(entry_id) for entry_id in entry_ids.split(",")])
+                           for path, score, entry_ids in self._conn.execute(
+                               "SELECT search_entries.path, MIN(search_fts.rank) AS score, "
+                               "GROUP_CONCAT(search_fts.rowid) "
+                               "FROM search_fts JOIN search_entries ON search_entries.id = search_fts.rowid "
+                               "WHERE search_fts MATCH ? GROUP BY search_entries.path ORDER BY score LIMIT ?",
+                               (match, limit))]
+            else:
+                newest = OrderedDict()
+                rows = self._conn.execute(
+                    "SELECT search_entries.path, search_fts.rowid "
+                    "FROM search_fts JOIN search_entries ON search_entries.id = search_fts.rowid "
+                    "WHERE search_fts MATCH ? ORDER BY search_fts.rowid DESC", (match,))
+                for path, entry_id in rows:
+                    if path not in newest and len(newest) == limit:
+                        break
+                    newest.setdefault(path, []).append(entry_id)
+                grouped = [(path, None, entry_ids) for path, entry_ids in newest.items()]
+
+            ids = [entry_id for _, _, entry_ids in grouped for entry_id in entry_ids]
+            entries = {}
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                entries.update((row[0], row[1:]) for row in self._conn.execute(
+                    "SELECT id, kind, image_hash, question, text FROM search_entries "
+                    f"WHERE id IN ({', '.join('?' * len(chunk))})", chunk))
+        results = []
+        for path, score, entry_ids in grouped:
+            matches = [entries[entry_id] for entry_id in entry_ids]
+            results.append({
+                "path": path,
+                "image_hash": next((image_hash for _, image_hash, _, _ in matches if image_hash), None),
+                "score": score,
+                "matches": [{"kind": kind, "question": question, "text": text}
+                            for kind, _, question, text in matches],
+            })
+        return results
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM search_entries").fetchone()[0]
+
+
+def make_thumbnail(image, size=THUMBNAIL_SIZE):
+    # Small JPEG of an ingested image, kept with a session instead of the image itself
+    thumbnail = image.copy()
+    thumbnail.thumbnail(size)
+    buffer = io.BytesIO()
+    thumbnail.save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+
+def pixmap_from_image(image):
+    # QPixmap of an RGB PIL image; the pixel bytes are handed to Qt without re-encoding
+    data = image.tobytes()
+    qimage = QImage(data, image.width, image.height, 3 * image.width, QImage.Format_RGB888)
+    return QPixmap.fromImage(qimage)
+
+
+class SessionStore:
+    # SQLite store of the window's sessions. A session keeps its image path, content hash and a
+    # thumbnail rather than the image itself; the full image is read from disk when shown
+    FIELDS = ("image_path", "image_hash", "thumbnail", "caption", "question", "answer")
+
+    def __init__(self, path=SESSION_STORE_PATH):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "id INTEGER PRIMARY KEY, image_path TEXT, image_hash TEXT, thumbnail BLOB, "
+                "caption TEXT, question TEXT, answer TEXT, updated REAL)"
+            )
+
+    def load(self):
+        rows = self._conn.execute(f"SELECT id, {', '.join(self.FIELDS)} FROM sessions ORDER BY id").fetchall()
+        return [dict(zip(("id",) + self.FIELDS, row)) for row in rows]
+
+    def next_id(self):
+        return self._conn.execute("SELECT COALESCE(MAX(id) + 1, 0) FROM sessions").fetchone()[0]
+
+    def save(self, session):
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (session['id'],) + tuple(session[field] for field in self.FIELDS) + (time.time(),),
+            )
+
 
 class CaptionModelLoader(QThread):
-    model_loaded = Signal(object, object)
+    # Loads a caption model into the registry ahead of the first request
+    model_loaded = Signal()
+
+    def __init__(self, models, name=None):
+        super().__init__()
+        self.models = models
+        self.name = name
 
     def run(self):
-        caption_processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-large")
-        caption_model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-large")
-        self.model_loaded.emit(caption_processor, caption_model)
+        self.models.policy.budget("caption").apply()
+        self.load_seconds = self.models.preload("caption", self.name)
+        self.model_loaded.emit()
 
 class QAModelLoader(QThread):
-    model_loaded = Signal(object, object)
+    model_loaded = Signal()
+
+    def __init__(self, models, name=None):
+        super().__init__()
+        self.models = models
+        self.name = name
 
     def run(self):
-        qa_processor = BlipProcessor.from_pretrained("Salesforce/blip-vqa-base")
-        qa_model = BlipForQuestionAnswering.from_pretrained("Salesforce/blip-vqa-base")
-        self.model_loaded.emit(qa_processor, qa_model)
+        self.models.policy.budget("answer").apply()
+        self.load_seconds = self.models.preload("answer", self.name)
+        self.model_loaded.emit()
 
-class CaptionGenerator(QThread):
-    caption_generated = Signal(str)
+class InferenceRequest:
+    # One unit of work for an InferenceWorker, tagged with the session it is answered to.
+    # Requests with the same coalesce_key supersede each other: submitting a new one cancels
+    # the previous one whether it is still queued or already generating
+    _ids = itertools.count(1)
 
-    def __init__(self, processor, model, image_path):
-        super().__init__()
-        self.processor = processor
-        self.model = model
+    def __init__(self, session_id, image_path, question="", priority=PRIORITY_INTERACTIVE, coalesce_key=None,
+                 ingested=None, model=None, tiled=False):
+        self.request_id = next(InferenceRequest._ids)
+        self.session_id = session_id
         self.image_path = image_path
+        self.model = model  # Model name for resolve_checkpoint, None for the default
+        self.tiled = tiled  # Caption regions of the image as well (caption_tiles)
+        self.ingested = ingested  # IngestedImage of image_path if the caller already decoded it
+        self.trace = RequestTrace()
+        self.submitted_at = None
+        self.question = question
+        self.priority = priority
+        self.coalesce_key = coalesce_key
+        self.cancelled = threading.Event()
+        self.reused = None  # {"image_hash", "distance"} if a near-duplicate's caption was returned
+        self.generation_stats = None  # TokenStreamer.stats() if the result was streamed
+
+    def cancel(self):
+        self.cancelled.set()
 
-    def run(self):
-        raw_image = Image.open(self.image_path).convert('RGB')
-        caption_inputs = self.processor(raw_image, return_tensors="pt")
-        caption_outputs = self.model.generate(**caption_inputs, max_new_tokens=50)
-        caption = self.processor.decode(caption_outputs[0], skip_special_tokens=True)
-        self.caption_generated.emit(caption)
-        
-class QuestionAnswerGenerator(QThread):
-    answer_generated = Signal(str)
 
-    def __init__(self, processor, model, image_path, question):
+class InferenceWorker(QThread):
+    # Long-lived thread that serves InferenceRequests of one kind from a priority queue (lower
+    # priority value first, then submission order). Results that lookup() finds cached are returned
+    # without the model; otherwise the request's model is borrowed from the ModelRegistry for the
+    # duration of the request only, so idle models can be unloaded. Cancelled requests are dropped
+    # when dequeued or stopped between decoding steps, and never produce a result
+    result_ready = Signal(object, str)
+    partial_ready = Signal(object, str)
+    request_failed = Signal(object, str)
+
+    kind = "inference"
+
+    def __init__(self, models, metrics=None, policy=None):
         super().__init__()
-        self.processor = processor
-        self.model = model
-        self.image_path = image_path
-        self.question = question
+        self.models = models
+        self.metrics = metrics
+        self.policy = policy or ExecutionPolicy()
+        self._queue = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._latest = {}
+        self._current = None
+        self._stopping = False
+        self._lock = threading.Lock()
+
+    def submit(self, request):
+        with self._lock:
+            if request.coalesce_key is not None:
+                previous = self._latest.get(request.coalesce_key)
+                if previous is not None:
+                    previous.cancel()
+                self._latest[request.coalesce_key] = request
+        request.submitted_at = time.perf_counter()
+        self._queue.put((request.priority, next(self._sequence), request))
+        return request
+
+    def stop(self):
+        # Abandon queued work, interrupt the running request and wait for the thread to end
+        with self._lock:
+            self._stopping = True
+            if self._current is not None:
+                self._current.cancel()
+        self._queue.put((float("-inf"), next(self._sequence), None))
+        self.wait()
 
     def run(self):
-        raw_image = Image.open(self.image_path).convert('RGB')
-        qa_inputs = self.processor(raw_image, self.question, return_tensors="pt")
-        qa_outputs = self.model.generate(**qa_inputs, max_new_tokens=50)
-        answer = self.processor.decode(qa_outputs[0], skip_special_tokens=True)
-        self.answer_generated.emit(answer)
+        self.policy.budget(self.kind).apply()
+        while True:
+            _, _, request = self._queue.get()
+            with self._lock:
+                if self._stopping:
+                    return
+                if request.cancelled.is_set():
+                    continue
+                self._current = request
+            request.trace.add("queue_wait", time.perf_counter() - request.submitted_at)
+
+            streamer = None
+            try:
+                text = self.lookup(request)
+                if text is None:
+                    with self.policy.run(request.trace), self.borrow_model(request) as (processor, model):
+                        streamer = TokenStreamer(processor,
+                                                 lambda text, request=request: self.partial_ready.emit(request, text),
+                                                 request.cancelled)
+                        text = self.process(request, processor, model, streamer)
+            except GenerationCancelled:
+                continue
+            except Exception as exc:
+                # A bad image must not take the worker down with it
+                self.request_failed.emit(request, str(exc))
+                continue
+            finally:
+                # Keeping the model referenced while waiting for the next request would stop the
+                # registry from unloading it
+                processor = model = None
+                with self._lock:
+                    self._current = None
+                    if self._latest.get(request.coalesce_key) is request:
+                        del self._latest[request.coalesce_key]
+
+            if request.cancelled.is_set():
+                continue
+            if streamer is not None and streamer.first_token_at is not None:
+                request.generation_stats = streamer.stats()
+            if self.metrics is not None:
+                self.metrics.record(self.kind, request.trace, request_id=request.request_id,
+                                    session_id=request.session_id, **(request.generation_stats or {}))
+            self.result_ready.emit(request, text)
+
+    def borrow_model(self, request):
+        return self.models.acquire(self.kind, request.model, request.trace)
+
+    def lookup(self, request):
+        # The request's result if it can be had without running the model, else None
+        return None
+
+    def process(self, request, processor, model, streamer):
+        raise NotImplementedError
+
+
+class InferenceClient:
+    # Client of a running `serve` process. One pooled requests.Session is shared by the caption
+    # and VQA workers so connections to the server are kept alive between requests
+    def __init__(self, base_url, timeout=300, pool_size=4):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _post_image(self, endpoint, image_path, params=None):
+        with open(image_path, "rb") as f:
+            image_bytes = f.read()
+        response = self.session.post(f"{self.base_url}{endpoint}", data=image_bytes, params=params,
+                                     headers={"Content-Type": "application/octet-stream"}, timeout=self.timeout)
+        if response.status_code != 200:
+            raise RuntimeError(response.json().get("error", response.reason))
+        return response.json()
+
+    def caption(self, image_path, model=None):
+        # (caption, reuse info or None), as for InferenceService.caption
+        result = self._post_image("/caption", image_path, {"model": model} if model else None)
+        return result["caption"], result.get("reused")
+
+    def answer(self, image_path, question, model=None):
+        return self.answers(image_path, [question], model)[0]
+
+    def answers(self, image_path, questions, model=None):
+        params = {"question": questions}
+        if model:
+            params["model"] = model
+        # The server answers a single question with "answer" and several with "answers"
+        result = self._post_image("/vqa", image_path, params)
+        return result["answers"] if "answers" in result else [result["answer"]]
+
+
+class RemoteInferenceWorker(InferenceWorker):
+    # Inference worker that forwards its requests to the server instead of running a model.
+    # Results are indexed locally, where the image paths are known
+    def __init__(self, client, kind, metrics=None, search_index=None):
+        super().__init__(None, metrics)
+        self.client = client
+        self.kind = kind
+        self.search_index = search_index
+
+    def borrow_model(self, request):
+        return nullcontext((None, None))
+
+    def process(self, request, processor, model, streamer):
+        # The server's own stages are exported by its /metrics endpoint
+        with request.trace.span("remote"):
+            image_hash = request.ingested.image_hash if request.ingested is not None else None
+            if self.kind == "caption":
+                caption, request.reused = self.client.caption(request.image_path, request.model)
+                if self.search_index is not None:
+                    self.search_index.add("caption", request.image_path, caption, image_hash=image_hash)
+                return caption
+            questions = split_questions(request.question)
+            answers = self.client.answers(request.image_path, questions, request.model)
+            if self.search_index is not None:
+                self.search_index.add_answers(request.image_path, questions, answers, image_hash)
+            return format_answers(questions, answers)
+
+
+class CaptionGenerator(InferenceWorker):
+    kind = "caption"
+
+    def __init__(self, models, result_cache, metrics=None, policy=None, near_duplicates=None, search_index=None):
+        super().__init__(models, metrics, policy)
+        self.result_cache = result_cache
+        self.near_duplicates = near_duplicates
+        self.search_index = search_index
+
+    def lookup(self, request):
+        # Cached results are keyed by the requested checkpoint and precision rather than by the
+        # loaded model's, so they are found without loading the model or waiting for it
+        checkpoint = resolve_checkpoint("caption", request.model)
+        precision = self.models.precision("caption")
+        if is_image_sequence(request.image_path):
+            if os.path.isdir(request.image_path):
+                return None  # Frame folders are not cached
+            cached = self.result_cache.get("caption_track", hash_image_file(request.image_path), checkpoint,
+                                           params=caption_track_params(precision))
+            return self.track_text(request, json.loads(cached)) if cached is not None else None
+        ingested = request.ingested
+        image_hash = ingested.image_hash if ingested is not None else hash_image_file(request.image_path)
+        if request.tiled:
+            cached = self.result_cache.get("caption_tiles", image_hash, checkpoint,
+                                           params=tiled_caption_params(precision))
+            return self.tiles_text(request, json.loads(cached)) if cached is not None else None
+
+        params = {"max_new_tokens": MAX_NEW_TOKENS, "precision": precision}
+        caption = self.result_cache.get("caption", image_hash, checkpoint, params=params)
+        if caption is None and self.near_duplicates is not None:
+            if ingested is None:
+                with request.trace.span("decode"):
+                    request.ingested = ingested = ingest_image(request.image_path)
+            # A re-encode, resize or burst shot of an already captioned image reuses its caption
+            with request.trace.span("lookup"):
+                caption, request.reused = reuse_near_duplicate_caption(
+                    self.result_cache, self.near_duplicates, perceptual_hash(ingested.image), checkpoint, params)
+        return self.caption_text(request, caption, image_hash) if caption is not None else None
+
+    def process(self, request, processor, model, streamer):
+        if is_image_sequence(request.image_path):
+            # Animated images get a caption track instead of a caption of their first frame
+            result = caption_sequence(
+                processor, model, request.image_path, self.result_cache,
+                on_progress=lambda track: self.partial_ready.emit(request, format_caption_track(track)),
+                cancelled=request.cancelled, trace=request.trace)
+            return self.track_text(request, result)
+        if request.tiled:
+            result = caption_tiles(processor, model, request.image_path, self.result_cache, trace=request.trace,
+                                   cancelled=request.cancelled)
+            return self.tiles_text(request, result)
+
+        ingested = request.ingested
+        if ingested is None:
+            with request.trace.span("decode"):
+                ingested = ingest_image(request.image_path)
+        params = {"max_new_tokens": MAX_NEW_TOKENS, "precision": model_precision(model)}
+        caption = caption_images(processor, model, [ingested.image], streamer=streamer, trace=request.trace,
+                                 cancelled=request.cancelled)[0]
+        self.result_cache.put("caption", ingested.image_hash, model.name_or_path, caption, params=params)
+        if self.near_duplicates is not None:
+            self.near_duplicates.add(ingested.image_hash, perceptual_hash(ingested.image))
+        return self.caption_text(request, caption, ingested.image_hash)
+
+    def track_text(self, request, result):
+        # Each result is indexed for search, then formatted for the caption box
+        if self.search_index is not None:
+            self.search_index.add("caption_track", request.image_path,
+                                  "\n".join(dict.fromkeys(entry["caption"] for entry in result["track"])))
+        return format_caption_track(result["track"])
+
+    def tiles_text(self, request, result):
+        if self.search_index is not None:
+            self.search_index.add("caption_tiles", request.image_path, tiled_caption_text(result),
+                                  image_hash=request.ingested.image_hash if request.ingested else None)
+        return format_tiled_caption(result)
+
+    def caption_text(self, request, caption, image_hash):
+        if self.search_index is not None:
+            self.search_index.add("caption", request.image_path, caption, image_hash=image_hash)
+        return caption
+
+
+class QuestionAnswerGenerator(InferenceWorker):
+    kind = "answer"
+
+    def __init__(self, models, embedding_cache, result_cache, metrics=None, policy=None, search_index=None):
+        super().__init__(models, metrics, policy)
+        self.embedding_cache = embedding_cache
+        self.result_cache = result_cache
+        self.search_index = search_index
+
+    def lookup(self, request):
+        # Only answered without the model if every question's answer is cached, under the
+        # requested checkpoint and precision
+        questions = split_questions(request.question)
+        image_hash = (request.ingested.image_hash if request.ingested is not None
+                      else hash_image_file(request.image_path))
+        checkpoint = resolve_checkpoint("answer", request.model)
+        params = {"max_new_tokens": MAX_NEW_TOKENS, "precision": self.models.precision("answer")}
+        answers = [self.result_cache.get("answer", image_hash, checkpoint, question, params)
+                   for question in questions]
+        if any(answer is None for answer in answers):
+            return None
+        return self.answers_text(request, questions, answers)
+
+    def process(self, request, processor, model, streamer):
+        # Each line of the question box is a separate question
+        questions = split_questions(request.question)
+        answers = answer_image_questions(processor, model, request.image_path, questions,
+                                         self.embedding_cache, self.result_cache, streamer=streamer,
+                                         ingested=request.ingested, trace=request.trace, cancelled=request.cancelled)
+        return self.answers_text(request, questions, answers)
+
+    def answers_text(self, request, questions, answers):
+        if self.search_index is not None:
+            self.search_index.add_answers(request.image_path, questions, answers,
+                                          request.ingested.image_hash if request.ingested is not None else None)
+        return format_answers(questions, answers)
 
 
 class MainWindow(QMainWindow):
-    def __init__(self):
+    def __init__(self, args=None):
         super().__init__()
+        self.use_snapshot = bool(args and args.snapshot)
+        self.caption_precision = args.caption_precision if args else "fp32"
+        self.qa_precision = args.qa_precision if args else "fp32"
+        self.backend = args.backend if args else "torch"
+        self.server_url = args.server if args else None
+
+        # How the two models share the CPU
+        self.execution_policy = ExecutionPolicy(args.thread_policy if args else "default",
+                                                pin=args.pin_cores if args else False)
+        print(f"Execution: {self.execution_policy.describe()}")
+
+        # Per-stage timings of every request, optionally exported to files
+        self.metrics = StageMetrics(args.metrics_jsonl if args else None, args.metrics_prom if args else None)
+
+        # Decoded image of the session on screen, reused by its caption and answer requests
+        self.current_image = None
+
+        # Sessions are kept on disk and restored on startup
+        self.session_store = SessionStore(args.session_store if args else SESSION_STORE_PATH)
 
         self.setWindowTitle("Image Caption Generator and Q&A")
         self.setWindowIcon(QIcon("picture.png"))  # Set the window icon with a relative path
 
         # Initialize UI elements
         self.init_ui()
+        # Show the restored session once the window is laid out, so the image is scaled to fit
+        QTimer.singleShot(0, lambda: self.load_session(self.current_session_index))
+        self.update_navigation_buttons()
+
+        # Vision-encoder outputs shared by follow-up questions on the same image
+        self.embedding_cache = ImageEmbeddingCache()
+
+        # Captions and answers persisted across runs, so re-uploaded images skip generation
+        self.result_cache = ResultCache()
+
+        # Perceptual hashes of captioned images, so near-identical uploads reuse their captions
+        threshold = args.near_duplicate_threshold if args else NEAR_DUPLICATE_THRESHOLD
+        self.near_duplicates = NearDuplicateIndex(threshold=threshold) if threshold >= 0 else None
+
+        # Every caption and answer shown is indexed for the search box, with its image's path
+        self.search_index = SearchIndex(args.search_index if args else SEARCH_INDEX_PATH)
+        self.search_dialog = None
 
-        # Placeholder for models
-        self.caption_processor = None
-        self.caption_model = None
-        self.qa_processor = None
-        self.qa_model = None
+        # Models are loaded on first use and unloaded when idle or over the memory budget
+        self.models = ModelRegistry(
+            (args.model_memory_mb if args else MODEL_MEMORY_BUDGET_MB) * 1024 * 1024,
+            args.model_idle_timeout if args else MODEL_IDLE_TIMEOUT, self.use_snapshot,
+            {"caption": self.caption_precision, "answer": self.qa_precision}, self.backend, self.execution_policy,
+            self.result_cache)
 
         # Flags to track model loading
         self.caption_model_loaded = False
         self.qa_model_loaded = False
 
+        # One long-lived worker per model, created once the model is loaded
+        self.caption_worker = None
+        self.qa_worker = None
+
+        # The VQA model is only loaded once the first question is asked
+        self.qa_loader = None
+        self.pending_question = None
+
         # Load models using threads
         self.load_models()
 
     def init_ui(self):
-        # Initialize session data
-        self.sessions = []
-        self.current_session_index = 0  # Start with the first session index
+        # Restore the saved sessions and reopen the last one
+        self.sessions = [dict(session, caption_request=None, answer_request=None)
+                         for session in self.session_store.load()]
+        self.session_ids = itertools.count(self.session_store.next_id())  # Results of queued requests are routed back by session id
 
         self.image_uploaded = False  # Track whether an image is uploaded
         self.text_in_input_area = False  # Track whether there is text in the input area
 
         # Initialize the first session
-        self.sessions.append({
-            'image': None,
-            'caption': '',
-            'question': '',
-            'answer': ''
-        })
+        if not self.sessions:
+            self.sessions.append(self.new_session())
+        self.current_session_index = len(self.sessions) - 1
 
         # Create the main layout
         main_layout = QVBoxLayout()
@@ -231,7 +2418,7 @@ class MainWindow(QMainWindow):
         right_container.setStyleSheet("background-color: #2c2c2c;")  # Grayish black background
 
         self.input_area = QTextEdit()
-        self.input_area.setPlaceholderText("Ask a question:")
+        self.input_area.setPlaceholderText("Ask a question (one per line for several):")
         self.input_area.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOn)  # Always show vertical scroll bar
         self.input_area.setHorizontalScrollBarPolicy(Qt.ScrollBarAsNeeded)  # Show horizontal scroll bar as needed
         self.input_area.setStyleSheet(
@@ -312,9 +2499,18 @@ class MainWindow(QMainWindow):
         self.prev_button.setStyleSheet(DISABLED_STYLE)
         self.next_button.setStyleSheet(DISABLED_STYLE)
 
+        # Search box over the captions and answers of every image captioned so far
+        self.search_box = QLineEdit()
+        self.search_box.setPlaceholderText("Search captions and answers")
+        self.search_box.setFixedSize(300, 40)
+        self.search_box.setStyleSheet("border-radius: 5px; padding: 5px; background-color: #f0f0f0; color: black;")
+        self.search_box.returnPressed.connect(self.search_library)
+
         bottom_layout.addWidget(self.add_button)
         bottom_layout.addWidget(self.prev_button)
         bottom_layout.addWidget(self.next_button)
+        bottom_layout.addStretch()
+        bottom_layout.addWidget(self.search_box)
 
         # Add all containers to the main layout
         main_layout.addWidget(top_container)
@@ -326,70 +2522,271 @@ class MainWindow(QMainWindow):
         central_widget.setLayout(main_layout)
         self.setCentralWidget(central_widget)
 
-        # Load the initial session
-        self.load_session(self.current_session_index)
-        self.update_navigation_buttons()
+        # Status bar with the latency breakdown of the last caption and answer, and the models
+        # the next requests are sent to
+        self.statusBar().setStyleSheet("background-color: #2c2c2c; color: white;")
+        self.caption_model_box = self.model_selector(CAPTION_MODELS, CAPTION_CHECKPOINT)
+        self.qa_model_box = self.model_selector(QA_MODELS, QA_CHECKPOINT)
+        self.statusBar().addPermanentWidget(QLabel("Caption model:"))
+        self.statusBar().addPermanentWidget(self.caption_model_box)
+        self.statusBar().addPermanentWidget(QLabel("Q&A model:"))
+        self.statusBar().addPermanentWidget(self.qa_model_box)
+        # Tiled captions describe regions of large images too; the server does not offer them
+        self.tiled_box = QCheckBox("Caption regions")
+        self.tiled_box.setEnabled(not self.server_url)
+        self.tiled_box.toggled.connect(self.recaption_image)
+        self.statusBar().addPermanentWidget(self.tiled_box)
+
+
+    def model_selector(self, models, default):
+        box = QComboBox()
+        box.setStyleSheet("background-color: #f0f0f0; color: black;")
+        names = list(models)
+        if default not in models.values():
+            names.insert(0, default)
+        box.addItems(names)
+        box.setCurrentIndex(next(index for index, name in enumerate(names) if models.get(name, name) == default))
+        return box
+
+    def load_models(self):
+        if self.server_url:
+            # Thin client: the models live in the server process
+            client = InferenceClient(self.server_url)
+            self.attach_caption_worker(RemoteInferenceWorker(client, "caption", self.metrics, self.search_index))
+            self.attach_qa_worker(RemoteInferenceWorker(client, "answer", self.metrics, self.search_index))
+            self.caption_model_loaded = True
+            self.qa_model_loaded = True
+            self.upload_button.setEnabled(True)
+            self.upload_button.setStyleSheet(BUTTON_STYLE_NORMAL)
+            return
+
+        # Load caption model; the QA model is loaded on demand by load_qa_model
+        self.caption_loader = CaptionModelLoader(self.models, self.caption_model_box.currentText())
+        self.caption_loader.model_loaded.connect(self.on_caption_model_loaded)
+        self.caption_loader.start()
+
+    def load_qa_model(self):
+        if self.qa_loader is not None:
+            return
+        self.qa_loader = QAModelLoader(self.models, self.qa_model_box.currentText())
+        self.qa_loader.model_loaded.connect(self.on_qa_model_loaded)
+        self.qa_loader.start()
+
+    def on_caption_model_loaded(self):
+        self.caption_model_loaded = True
+        print(f"Caption model loaded in {self.caption_loader.load_seconds:.2f}s")
+        self.statusBar().showMessage(f"Caption model loaded in {self.caption_loader.load_seconds:.2f}s, "
+                                     f"{self.execution_policy.name} thread policy")
+        self.execution_policy.apply_process_settings()
+        self.attach_caption_worker(CaptionGenerator(self.models, self.result_cache, self.metrics,
+                                                    self.execution_policy, self.near_duplicates, self.search_index))
+    
+        # Enable the upload button when the caption model is loaded
+        self.upload_button.setEnabled(True)
+        self.upload_button.setStyleSheet(BUTTON_STYLE_NORMAL)
+
+
+    def on_qa_model_loaded(self):
+        self.qa_model_loaded = True
+        print(f"QA model loaded in {self.qa_loader.load_seconds:.2f}s")
+        self.statusBar().showMessage(f"Q&A model loaded in {self.qa_loader.load_seconds:.2f}s")
+        self.attach_qa_worker(QuestionAnswerGenerator(self.models, self.embedding_cache, self.result_cache,
+                                                      self.metrics, self.execution_policy, self.search_index))
+
+        # Answer the question that triggered the load, unless the image was cleared meanwhile
+        pending, self.pending_question = self.pending_question, None
+        if pending and self.image_uploaded and pending[0] == self.current_session()['id']:
+            self.start_answer_generation(pending[1])
+        elif pending:
+            self.output_area.clear()
+            self.output_area.setStyleSheet("background-color: #f0f0f0; color: black;")  # Reset to default style
+            self.update_clear_button_state()
+
+    def attach_caption_worker(self, worker):
+        self.caption_worker = worker
+        self.caption_worker.result_ready.connect(self.on_caption_result)
+        self.caption_worker.partial_ready.connect(self.on_caption_partial)
+        self.caption_worker.request_failed.connect(
+            lambda request, message: self.on_caption_result(request, f"Could not caption the image: {message}"))
+        self.caption_worker.start()
+
+    def attach_qa_worker(self, worker):
+        self.qa_worker = worker
+        self.qa_worker.result_ready.connect(self.on_answer_result)
+        self.qa_worker.partial_ready.connect(self.on_answer_partial)
+        self.qa_worker.request_failed.connect(
+            lambda request, message: self.on_answer_result(request, f"Could not answer the question: {message}"))
+        self.qa_worker.start()
+
+    def upload_image(self):
+        file_dialog = QFileDialog()
+        file_path, _ = file_dialog.getOpenFileName(self, "Upload Image", "", "Images (*.png *.xpm *.jpg *.jpeg *.bmp *.gif)")
+    
+        if file_path:
+            self.open_image(file_path)
+
+    def open_image(self, file_path):
+        # Decode once at reduced size; the same image is displayed and sent to the models
+        decode_started = time.perf_counter()
+        try:
+            ingested = ingest_image(file_path)
+        except (OSError, ValueError, Image.DecompressionBombError) as exc:
+            self.caption_area.setText(f"Could not open the image: {exc}")
+            self.caption_area.setStyleSheet(STATUS_STYLE)
+            return
+        self.current_image = ingested
+        self.show_image(ingested)
+        self.image_uploaded = True
+        session = self.current_session()
+        session.update(image_path=file_path, image_hash=ingested.image_hash,
+                       thumbnail=make_thumbnail(ingested.image))
+        self.persist_session(session)
+        self.update_clear_image_button_state()
+
+        # Disable the generate button and clear image button, show status message in caption area
+        self.generate_button.setEnabled(False)
+        self.generate_button.setStyleSheet(DISABLED_STYLE)
+        self.clear_image_button.setEnabled(False)
+        self.clear_image_button.setStyleSheet(DISABLED_STYLE)
+        self.caption_area.setText("Caption is being generated...")
+        self.caption_area.setStyleSheet(STATUS_STYLE)
+
+        # Clear the output area when a new image is uploaded
+        self.output_area.clear()
+        self.output_area.setStyleSheet("background-color: #f0f0f0; color: black;")  # Set to default white background
+
+        # Check if the caption model is loaded before queueing the caption request. A caption
+        # still being generated for this session's previous image is superseded by this one.
+        # Region captions and caption tracks run many generations, so plain captions of other
+        # sessions queued meanwhile go first
+        if self.caption_model_loaded:
+            tiled = self.tiled_box.isChecked()
+            priority = PRIORITY_BACKGROUND if tiled or is_image_sequence(file_path) else PRIORITY_INTERACTIVE
+            request = InferenceRequest(session['id'], file_path, priority=priority,
+                                       coalesce_key=("caption", session['id']), ingested=ingested,
+                                       model=self.caption_model_box.currentText(), tiled=tiled)
+            request.trace.add("decode", time.perf_counter() - decode_started)
+            session['caption_request'] = self.caption_worker.submit(request)
+        else:
+            self.output_area.setText("Caption model is still loading, please wait...")
+            self.output_area.setStyleSheet(STATUS_STYLE)
+
+    def show_image(self, ingested):
+        self.image_label.setPixmap(pixmap_from_image(ingested.image).scaled(
+            self.image_label.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation))
+
+    def recaption_image(self):
+        # Caption the shown image again, e.g. with or without regions
+        if self.image_uploaded and self.caption_model_loaded:
+            self.open_image(self.current_session()['image_path'])
 
+    def search_library(self):
+        # Matching images are listed in a window of their own; activating one opens it
+        query = self.search_box.text().strip()
+        if not query:
+            return
+        started = time.perf_counter()
+        results = self.search_index.search(query)
+        elapsed = time.perf_counter() - started
 
-    def load_models(self):
-        # Load caption model
-        self.caption_loader = CaptionModelLoader()
-        self.caption_loader.model_loaded.connect(self.on_caption_model_loaded)
-        self.caption_loader.start()
+        if self.search_dialog is None:
+            self.search_dialog = QDialog(self)
+            self.search_dialog.resize(700, 500)
+            self.search_dialog.setStyleSheet("background-color: #2c2c2c; color: white;")
+            layout = QVBoxLayout(self.search_dialog)
+            self.search_summary = QLabel()
+            self.search_results = QListWidget()
+            self.search_results.setStyleSheet("background-color: #f0f0f0; color: black;")
+            self.search_results.itemActivated.connect(self.open_search_result)
+            layout.addWidget(self.search_summary)
+            layout.addWidget(self.search_results)
+        self.search_dialog.setWindowTitle(f"Search: {query}")
+        self.search_summary.setText(f"{len(results)} images for \"{query}\" ({elapsed * 1000:.0f} ms)"
+                                    + (", double-click one to open it" if results else ""))
+        self.search_results.clear()
+        for result in results:
+            matches = [f"{match['question']} {match['text']}" if match['question'] else match['text']
+                       for match in result['matches']]
+            item = QListWidgetItem(f"{os.path.basename(result['path'])}: {' | '.join(matches)}")
+            item.setToolTip(result['path'])
+            item.setData(Qt.UserRole, result['path'])
+            self.search_results.addItem(item)
+        self.search_dialog.show()
+        self.search_dialog.raise_()
 
-        # Load QA model
-        self.qa_loader = QAModelLoader()
-        self.qa_loader.model_loaded.connect(self.on_qa_model_loaded)
-        self.qa_loader.start()
+    def open_search_result(self, item):
+        path = item.data(Qt.UserRole)
+        if not os.path.isfile(path):
+            self.statusBar().showMessage(f"{path} cannot be opened here; it was moved, deleted or is a frame folder")
+            return
+        if not self.caption_model_loaded:
+            self.statusBar().showMessage("Caption model is still loading, please wait...")
+            return
+        # A session already showing an image is kept; the result opens in a new one
+        if self.image_uploaded:
+            self.add_session()
+        self.open_image(path)
 
-    def on_caption_model_loaded(self, processor, model):
-        self.caption_processor = processor
-        self.caption_model = model
-        self.caption_model_loaded = True
-        print("Caption model loaded")
-    
-        # Enable the upload button when the caption model is loaded
-        self.upload_button.setEnabled(True)
-        self.upload_button.setStyleSheet(BUTTON_STYLE_NORMAL)
+    def is_latest_request(self, request, slot):
+        # Results are only used if the request is still the newest of its kind for its session
+        session = self.find_session(request.session_id)
+        return session is not None and session.get(slot) is request
 
+    def on_caption_partial(self, request, text):
+        # Show the caption as it is decoded instead of the status message
+        if request.session_id != self.current_session()['id'] or not self.is_latest_request(request, 'caption_request'):
+            return
+        self.caption_area.setText(text)
+        self.caption_area.setStyleSheet("background-color: #f0f0f0; color: black;")  # Reset to default style
 
-    def on_qa_model_loaded(self, processor, model):
-        self.qa_processor = processor
-        self.qa_model = model
-        self.qa_model_loaded = True
-        print("QA model loaded")
+    def on_answer_partial(self, request, text):
+        if request.session_id != self.current_session()['id'] or not self.is_latest_request(request, 'answer_request'):
+            return
+        self.output_area.setText(text)
+        self.output_area.setStyleSheet("background-color: #f0f0f0; color: black;")  # Reset to default style
 
-    def upload_image(self):
-        file_dialog = QFileDialog()
-        file_path, _ = file_dialog.getOpenFileName(self, "Upload Image", "", "Images (*.png *.xpm *.jpg *.jpeg *.bmp *.gif)")
-    
-        if file_path:
-            pixmap = QPixmap(file_path)
-            self.image_label.setPixmap(pixmap.scaled(self.image_label.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation))
-            self.current_image_path = file_path
-            self.image_uploaded = True
-            self.update_clear_image_button_state()
-
-            # Disable the generate button and clear image button, show status message in caption area
-            self.generate_button.setEnabled(False)
-            self.generate_button.setStyleSheet(DISABLED_STYLE)
-            self.clear_image_button.setEnabled(False)
-            self.clear_image_button.setStyleSheet(DISABLED_STYLE)
-            self.caption_area.setText("Caption is being generated...")
-            self.caption_area.setStyleSheet(STATUS_STYLE)
+    def on_caption_result(self, request, caption):
+        if not self.is_latest_request(request, 'caption_request'):
+            return
+        if request.reused is not None:
+            self.statusBar().showMessage(f"Caption reused from a near-duplicate image "
+                                         f"({request.reused['distance']} of 64 bits differ): {request.trace.summary()}")
+        else:
+            self.statusBar().showMessage(f"Caption: {self.request_summary(request)}")
+        session = self.find_session(request.session_id)
+        session['caption_request'] = None
+        if request.session_id == self.current_session()['id']:
+            self.on_caption_generated(caption)
+        else:
+            # The user moved to another session meanwhile; keep the caption for when they return
+            session['caption'] = caption
+            self.persist_session(session)
 
-            # Clear the output area when a new image is uploaded
-            self.output_area.clear()
-            self.output_area.setStyleSheet("background-color: #f0f0f0; color: black;")  # Set to default white background
+    def on_answer_result(self, request, answer):
+        if not self.is_latest_request(request, 'answer_request'):
+            return
+        message = f"Answer: {self.request_summary(request)}"
+        if not self.server_url:
+            # With --server the answers come from the server and this cache is not used
+            stats = self.embedding_cache.stats()
+            message += f", image embeddings {stats['hits']} hits / {stats['misses']} misses"
+        self.statusBar().showMessage(message)
+        session = self.find_session(request.session_id)
+        session['answer_request'] = None
+        if request.session_id == self.current_session()['id']:
+            self.on_answer_generated(answer)
+        else:
+            session['answer'] = answer
+            self.persist_session(session)
 
-            # Check if the caption model is loaded before starting the caption generation thread
-            if self.caption_model_loaded:
-                self.generate_caption_thread = CaptionGenerator(self.caption_processor, self.caption_model, file_path)
-                self.generate_caption_thread.caption_generated.connect(self.on_caption_generated)
-                self.generate_caption_thread.start()
-            else:
-                self.output_area.setText("Caption model is still loading, please wait...")
-                self.output_area.setStyleSheet(STATUS_STYLE)
+    def request_summary(self, request):
+        # Stage timings, then how fast the text was streamed if it was generated
+        summary = request.trace.summary()
+        stats = request.generation_stats
+        if stats is not None:
+            summary += (f", first token after {stats['time_to_first_token'] * 1000:.0f} ms, "
+                        f"{stats['tokens']} tokens at {stats['tokens_per_second']:.1f} tokens/s")
+        return summary
 
     def on_caption_generated(self, caption):
         self.caption_area.setText(caption)
@@ -411,29 +2808,42 @@ class MainWindow(QMainWindow):
             self.output_area.setStyleSheet("background-color: #f0f0f0; color: black;")  # Reset to default style
             return
 
-        if not self.caption_processor or not self.caption_model or not self.qa_processor or not self.qa_model:
+        if not self.caption_model_loaded:
             self.output_area.setText("Models are still loading, please wait.")
             self.output_area.setStyleSheet("background-color: #f0f0f0; color: black;")  # Reset to default style
             return
 
-        # Show status message for answer generation
-        self.output_area.setText("Answer is being generated...")
-        self.output_area.setStyleSheet(STATUS_STYLE)
+        # Get the question from input area
+        question = self.input_area.toPlainText().strip()
+        if not question:
+            self.output_area.setText("")
+            self.output_area.setStyleSheet("background-color: #f0f0f0; color: black;")  # Reset to default style
+            return
 
         # Disable the clear button while generating answer
         self.clear_button.setEnabled(False)
         self.clear_button.setStyleSheet(DISABLED_STYLE)
 
-        # Get the question from input area
-        question = self.input_area.toPlainText().strip()
-        if question:
-            # Start the QA generation thread
-            self.qa_thread = QuestionAnswerGenerator(self.qa_processor, self.qa_model, self.current_image_path, question)
-            self.qa_thread.answer_generated.connect(self.on_answer_generated)
-            self.qa_thread.start()
-        else:
-            self.output_area.setText("")
-            self.output_area.setStyleSheet("background-color: #f0f0f0; color: black;")  # Reset to default style
+        if not self.qa_model_loaded:
+            # First question: load the QA model now and answer once it is ready
+            self.pending_question = (self.current_session()['id'], question)
+            self.output_area.setText("Loading the Q&A model, the answer will follow...")
+            self.output_area.setStyleSheet(STATUS_STYLE)
+            self.load_qa_model()
+            return
+
+        self.start_answer_generation(question)
+
+    def start_answer_generation(self, question):
+        # Show status message for answer generation
+        self.output_area.setText("Answer is being generated...")
+        self.output_area.setStyleSheet(STATUS_STYLE)
+
+        # Queue the question; an unanswered earlier question of this session is superseded
+        session = self.current_session()
+        session['answer_request'] = self.qa_worker.submit(InferenceRequest(
+            session['id'], session['image_path'], question, coalesce_key=("answer", session['id']),
+            ingested=self.current_image, model=self.qa_model_box.currentText()))
 
 
     def on_answer_generated(self, answer):
@@ -445,7 +2855,14 @@ class MainWindow(QMainWindow):
         self.clear_button.setStyleSheet(BUTTON_STYLE_NORMAL)
         
     def clear_image(self):
-        # Clear the image label and caption area
+        # Clear the image label and caption area, dropping a caption still being generated
+        request = self.current_session().get('caption_request')
+        if request is not None:
+            request.cancel()
+            self.current_session()['caption_request'] = None
+        self.current_session().update(image_path=None, image_hash=None, thumbnail=None, caption='')
+        self.persist_session(self.current_session())
+        self.current_image = None
         self.image_label.clear()
         self.caption_area.clear()
         self.image_uploaded = False
@@ -457,23 +2874,52 @@ class MainWindow(QMainWindow):
         self.output_area.clear()
         self.update_clear_button_state()
 
-    def add_session(self):
-        # Save the current session before adding a new one
-        self.sessions[self.current_session_index] = {
-            'image': self.image_label.pixmap(),
+    def new_session(self):
+        return {
+            'id': next(self.session_ids),
+            'image_path': None,
+            'image_hash': None,
+            'thumbnail': None,
+            'caption': '',
+            'question': '',
+            'answer': '',
+            'caption_request': None,
+            'answer_request': None
+        }
+
+    def current_session(self):
+        return self.sessions[self.current_session_index]
+
+    def find_session(self, session_id):
+        for session in self.sessions:
+            if session['id'] == session_id:
+                return session
+        return None
+
+    def save_current_session(self):
+        # Update in place so the session keeps its id and its in-flight requests
+        self.current_session().update({
             'caption': self.caption_area.toPlainText(),
             'question': self.input_area.toPlainText(),
             'answer': self.output_area.toPlainText()
-        }
+        })
+        self.persist_session(self.current_session())
+
+    def persist_session(self, session):
+        # Status messages of requests still in flight are not worth restoring
+        self.session_store.save(dict(
+            session,
+            caption='' if session['caption_request'] else session['caption'],
+            answer='' if session['answer_request'] else session['answer']
+        ))
+
+    def add_session(self):
+        # Save the current session before adding a new one
+        self.save_current_session()
 
         # Add new session and set it as the current session
-        self.sessions.append({
-            'image': None,
-            'caption': '',
-            'question': '',
-            'answer': ''
-        })
-        self.current_session_index += 1  # Increment index to point to the new session
+        self.sessions.append(self.new_session())
+        self.current_session_index = len(self.sessions) - 1  # Point to the new session
 
         # Load the new session
         self.load_session(self.current_session_index)
@@ -483,12 +2929,7 @@ class MainWindow(QMainWindow):
     def previous_session(self):
         if self.current_session_index > 0:
             # Save current session before switching
-            self.sessions[self.current_session_index] = {
-                'image': self.image_label.pixmap(),
-                'caption': self.caption_area.toPlainText(),
-                'question': self.input_area.toPlainText(),
-                'answer': self.output_area.toPlainText()
-            }
+            self.save_current_session()
             self.current_session_index -= 1
             self.load_session(self.current_session_index)
             self.update_navigation_buttons()
@@ -497,12 +2938,7 @@ class MainWindow(QMainWindow):
     def next_session(self):
         if self.current_session_index < len(self.sessions) - 1:
             # Save current session before switching
-            self.sessions[self.current_session_index] = {
-                'image': self.image_label.pixmap(),
-                'caption': self.caption_area.toPlainText(),
-                'question': self.input_area.toPlainText(),
-                'answer': self.output_area.toPlainText()
-            }
+            self.save_current_session()
             self.current_session_index += 1
             self.load_session(self.current_session_index)
             self.update_navigation_buttons()
@@ -510,18 +2946,39 @@ class MainWindow(QMainWindow):
 
     def load_session(self, index):
         session = self.sessions[index]
-        if session['image']:
-            self.image_label.setPixmap(session['image'])
+        # Only the shown session's image is held decoded; others keep just their thumbnail
+        self.current_image = None
+        if session['image_path']:
+            try:
+                self.current_image = ingest_image(session['image_path'])
+            except (OSError, ValueError, Image.DecompressionBombError):
+                pass  # The original file is gone or unreadable; fall back to the thumbnail
+        thumbnail = QPixmap()
+        if self.current_image is not None:
+            self.show_image(self.current_image)
+        elif session['thumbnail'] and thumbnail.loadFromData(session['thumbnail']):
+            self.image_label.setPixmap(thumbnail.scaled(self.image_label.size(), Qt.KeepAspectRatio,
+                                                        Qt.SmoothTransformation))
         else:
             self.image_label.clear()
         self.caption_area.setText(session['caption'])
         self.input_area.setText(session['question'])
         self.output_area.setText(session['answer'])
-        self.image_uploaded = session['image'] is not None
+        self.image_uploaded = self.current_image is not None
         self.update_clear_image_button_state()
         self.update_clear_button_state()
 
 
+    def closeEvent(self, event):
+        self.save_current_session()
+
+        # Stop the inference workers so no generation outlives the window
+        for worker in (self.caption_worker, self.qa_worker):
+            if worker is not None:
+                worker.stop()
+        self.models.close()
+        super().closeEvent(event)
+
     def update_clear_image_button_state(self):
         if self.image_label.pixmap() and not self.image_label.pixmap().isNull():
             self.clear_image_button.setEnabled(True)
@@ -556,10 +3013,1626 @@ class MainWindow(QMainWindow):
             self.next_button.setStyleSheet(DISABLED_STYLE)
 
 
-if __name__ == "__main__":
+class MicroBatcher:
+    # Groups items submitted from many threads into batches for run_batch. A batch is started
+    # once max_batch_size items are waiting or max_wait seconds after its first item arrived,
+    # whichever comes first; each submitter blocks until its own result is ready. With a
+    # concurrency above 1, that many batches are formed and run at the same time (one per replica)
+    def __init__(self, run_batch, max_batch_size=SERVER_MAX_BATCH_SIZE, max_wait=SERVER_MAX_WAIT_MS / 1000,
+                 kind="inference", policy=None, concurrency=1):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.kind = kind
+        self.policy = policy or ExecutionPolicy()
+        self.batches = 0  # Batches run so far, for /health
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        for _ in range(concurrency):
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, item):
+        return self.submit_many([item])[0]
+
+    def submit_many(self, items):
+        # Queue all items before waiting so they can share a batch
+        futures = []
+        for item in items:
+            future = Future()
+            self._queue.put((item, future))
+            futures.append(future)
+        return [future.result() for future in futures]
+
+    def _run(self):
+        self.policy.budget(self.kind).apply()
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            with self._lock:
+                self.batches += 1
+            try:
+                with self.policy.run():
+                    results = self.run_batch([item for item, _ in batch])
+            except Exception as exc:
+                for _, future in batch:
+                    future.set_exception(exc)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+
+def snapshot_writer_main(checkpoint, model_class_name):
+    # Runs in a short-lived process, so the parent never holds a from_pretrained copy of the weights
+    load_blip_checkpoint(checkpoint, model_class_name, use_snapshot=True)
+
+
+def ensure_snapshot(checkpoint, model_class_name):
+    # Write the memory-mappable snapshot replicas load from, unless a current one exists
+    if snapshot_is_current(checkpoint):
+        return
+    from multiprocessing import get_context
+
+    print(f"Writing a snapshot of {checkpoint} for the replicas", file=sys.stderr)
+    process = get_context("spawn").Process(target=snapshot_writer_main, args=(checkpoint, model_class_name))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f"Could not load {checkpoint} (exit code {process.exitcode})")
+
+
+def replica_main(conn, kind, checkpoint, precision, budget):
+    # Runs in a replica process: map the model from its snapshot, report ready, then run the
+    # batches sent by the ReplicaPool one at a time until the pipe is closed
+    budget.apply()  # Cores first, so the threads torch starts inherit them
+    started = time.perf_counter()
+    processor, model = load_blip_checkpoint(checkpoint, ModelRegistry.MODEL_CLASSES[kind], True, precision,
+                                            thread_budget=budget)
+    budget.apply()  # Thread counts need torch imported
+    try:
+        sys.modules["torch"].set_num_interop_threads(budget.inter_op)
+    except RuntimeError:
+        pass
+    conn.send({"load_seconds": time.perf_counter() - started, "name_or_path": model.name_or_path,
+               "revision": checkpoint_revision(model)})
+    while True:
+        try:
+            items = conn.recv()
+        except EOFError:
+            return
+        trace = RequestTrace()
+        try:
+            if kind == "caption":
+                results = caption_images(processor, model, items, trace=trace)
+            else:
+                results = answer_batch(processor, model, items, trace)
+        except Exception as exc:
+            conn.send(("error", str(exc), trace.stages))
+            continue
+        conn.send(("ok", results, trace.stages))
+
+
+def process_memory_mb(pid):
+    # Resident and proportional set size of a process (Linux). Pages shared by n processes count
+    # fully towards each one's RSS but 1/n towards its PSS, so PSS shows what sharing saves
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            fields = dict(line.split(":", 1) for line in f if line[:4] in ("Rss:", "Pss:"))
+    except OSError:
+        return {}
+    return {f"{name.lower()}_mb": round(int(value.split()[0]) / 1024) for name, value in fields.items()}
+
+
+class ReplicaPool:
+    # count worker processes running the same model, for the server to scale past the cores one
+    # process can use. Replicas take batches from one shared queue as soon as they are free, so
+    # work always goes to an idle replica. Each replica maps the model from its snapshot with
+    # torch.load(mmap=True); the fp32 weights are only read, so all replicas share the same
+    # page-cache pages and cost about one copy of the weights between them (int8 and bf16
+    # convert the weights and lose that). A replica that dies is restarted, and the batch it
+    # was running is retried once on another replica. A replica that cannot be started
+    # REPLICA_MAX_FAILED_STARTS times in a row fails the pool and every batch waiting for it
+    def __init__(self, kind, checkpoint, count, precision="fp32", budget=None, metrics=None, result_cache=None):
+        from multiprocessing import get_context
+
+        self.kind = kind
+        self.checkpoint = checkpoint
+        self.precision = precision
+        self.metrics = metrics
+        self.result_cache = result_cache
+        self.created = time.monotonic()
+        self._context = get_context("spawn")
+        self._queue = queue.Queue()
+        self._closed = threading.Event()
+        self._lock = threading.Lock()
+        self.error = None
+        ensure_snapshot(checkpoint, ModelRegistry.MODEL_CLASSES[kind])
+        self.replicas = [{"id": index, "budget": replica_budget, "process": None, "conn": None, "state": "starting",
+                          "batches": 0, "items": 0, "busy": 0.0, "starts": 0, "failed_starts": 0}
+                         for index, replica_budget in enumerate((budget or ThreadBudget()).split(count))]
+        for replica in self.replicas:
+            threading.Thread(target=self._serve, args=(replica,), daemon=True).start()
+
+    def run(self, items):
+        # Run one batch on the next free replica and wait for its results
+        future = Future()
+        with self._lock:
+            if self.error is not None:
+                raise RuntimeError(self.error)
+            self._queue.put((items, future, 0))
+        return future.result()
+
+    def _start(self, replica):
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(target=replica_main, daemon=True, args=(
+            child_conn, self.kind, self.checkpoint, self.precision, replica["budget"]))
+        replica.update(state="starting", process=process, conn=parent_conn)
+        replica["starts"] += 1
+        process.start()
+        child_conn.close()  # The parent's recv then fails as soon as the replica exits
+        ready = parent_conn.recv()
+        if self.result_cache is not None and replica["starts"] == 1:
+            self.result_cache.sync_checkpoint(ready["name_or_path"], ready["revision"])
+        replica.update(state="idle", failed_starts=0)
+        print(f"Replica {replica['id']} of {self.checkpoint} ready in {ready['load_seconds']:.2f}s "
+              f"(pid {process.pid})", file=sys.stderr)
+
+    def _stop(self, replica):
+        process = replica["process"]
+        replica["conn"].close()
+        process.join(timeout=5)
+        if process.is_alive():
+            process.kill()
+            process.join()
+        if not self._closed.is_set():
+            print(f"Replica {replica['id']} of {self.checkpoint} exited (exit code {process.exitcode}), "
+                  f"restarting", file=sys.stderr)
+        replica.update(process=None, conn=None, state="restarting")
+
+    def _serve(self, replica):
+        # One dispatcher thread per replica: (re)starts it and feeds it batches
+        while not self._closed.is_set():
+            if replica["process"] is not None and not replica["process"].is_alive():
+                self._stop(replica)  # Exited while idle
+            if replica["process"] is None:
+                try:
+                    self._start(replica)
+                except (EOFError, OSError):
+                    self._stop(replica)
+                    replica["failed_starts"] += 1
+                    if replica["failed_starts"] >= REPLICA_MAX_FAILED_STARTS:
+                        self._fail(f"A replica of {self.checkpoint} failed to start "
+                                   f"{replica['failed_starts']} times in a row")
+                        break
+                    self._closed.wait(1)  # Failed while loading; do not restart in a tight loop
+                continue
+            try:
+                items, future, attempts = self._queue.get(timeout=1)  # Wakes up to notice idle crashes
+            except queue.Empty:
+                continue
+            if future is None:
+                break
+
+            replica["state"] = "busy"
+            started = time.perf_counter()
+            try:
+                replica["conn"].send(items)
+                status, result, stages = replica["conn"].recv()
+            except (EOFError, OSError):
+                # The replica died in the middle of the batch; the loop starts a new one
+                self._stop(replica)
+                if attempts == 0 and not self._closed.is_set():
+                    self._queue.put((items, future, 1))
+                else:
+                    future.set_exception(RuntimeError("A replica exited twice while running this batch"))
+                continue
+            except Exception as exc:
+                # The batch could not be sent, e.g. it does not pickle; the replica is fine
+                future.set_exception(exc)
+                continue
+            finally:
+                replica["busy"] += time.perf_counter() - started
+                if replica["process"] is not None:
+                    replica["state"] = "idle"
+
+            replica["batches"] += 1
+            replica["items"] += len(items)
+            if self.metrics is not None:
+                trace = RequestTrace()
+                for stage, seconds in stages.items():
+                    trace.add(stage, seconds)
+                self.metrics.record(f"{self.kind}_batch", trace, batch_size=len(items), replica=replica["id"])
+            if status == "ok":
+                future.set_result(result)
+            else:
+                future.set_exception(RuntimeError(result))
+
+    def _fail(self, error):
+        # Stop every replica and fail the queued batches instead of leaving their requests waiting
+        with self._lock:
+            if self.error is None:
+                print(error, file=sys.stderr)
+                self.error = error
+                self.close()
+        while True:
+            try:
+                items, future, attempts = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if future is not None:
+                future.set_exception(RuntimeError(self.error))
+
+    def close(self):
+        self._closed.set()
+        for _ in self.replicas:
+            self._queue.put((None, None, 0))
+        for replica in self.replicas:
+            process = replica["process"]
+            if process is not None and process.is_alive():
+                process.terminate()
+
+    def describe(self):
+        # Per-replica utilization is the share of the pool's lifetime the replica spent on batches
+        elapsed = max(time.monotonic() - self.created, 1e-9)
+        replicas = []
+        for replica in self.replicas:
+            process = replica["process"]
+            entry = {"id": replica["id"], "pid": process.pid if process is not None else None,
+                     "state": replica["state"], "batches": replica["batches"], "items": replica["items"],
+                     "restarts": max(0, replica["starts"] - 1), "utilization": round(replica["busy"] / elapsed, 3)}
+            if process is not None and process.pid is not None:
+                entry.update(process_memory_mb(process.pid))
+            replicas.append(entry)
+        description = {"checkpoint": self.checkpoint, "precision": self.precision, "queued": self._queue.qsize(),
+                       "replicas": replicas}
+        if self.error is not None:
+            description["error"] = self.error
+        return description
+
+
+class InferenceService:
+    # The models behind the HTTP server: concurrent requests are micro-batched per model and
+    # results are shared with the GUI and batch paths through the result cache. Models come
+    # from the registry, so requests can pick a checkpoint and idle models are unloaded. With
+    # replicas, each model instead runs in that many ReplicaPool processes, which are kept
+    # until the server stops, and as many batches per model run at once. As those bypass the
+    # registry's memory budget, replicas only run the default and the named checkpoints
+    def __init__(self, models, result_cache, max_batch_size=SERVER_MAX_BATCH_SIZE,
+                 max_wait=SERVER_MAX_WAIT_MS / 1000, metrics=None, policy=None, near_duplicates=None,
+                 search_index=None, replicas=0):
+        self.metrics = metrics or StageMetrics()
+        self.policy = policy or ExecutionPolicy()
+        self.near_duplicates = near_duplicates
+        self.search_index = search_index
+        self.models = models
+        self.result_cache = result_cache
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.replicas = replicas
+        self.batchers = {}
+        self.pools = {}
+        self._start_locks = {}
+        self._lock = threading.Lock()
+
+    def replica_checkpoints(self, kind):
+        names = CAPTION_MODELS if kind == "caption" else QA_MODELS
+        return {resolve_checkpoint(kind), *names.values()}
+
+    def batcher(self, kind, checkpoint):
+        # One micro-batcher per model, as requests for different checkpoints cannot share a batch
+        key = (kind, checkpoint)
+        with self._lock:
+            pool = self.pools.get(key)
+            if key in self.batchers and (pool is None or pool.error is None):
+                return self.batchers[key]
+            start_lock = self._start_locks.setdefault(key, threading.Lock())
+        if not self.replicas:
+            run_batch = self._caption_batch if kind == "caption" else self._vqa_batch
+            with self._lock:
+                if key not in self.batchers:
+                    self.batchers[key] = MicroBatcher(lambda items: run_batch(checkpoint, items),
+                                                      self.max_batch_size, self.max_wait, kind, self.policy)
+                return self.batchers[key]
+
+        if checkpoint not in self.replica_checkpoints(kind):
+            raise ValueError(f"With replicas, the model must be one of: "
+                             f"{', '.join(sorted(self.replica_checkpoints(kind)))}")
+        # A new pool is started under its own lock: requests for that model wait for it, others do
+        # not. A pool whose replicas failed to start is replaced by a new one on the next request
+        with start_lock:
+            with self._lock:
+                pool = self.pools.get(key)
+                if pool is not None and pool.error is None:
+                    return self.batchers[key]
+            pool = ReplicaPool(kind, checkpoint, self.replicas, self.models.precision(kind),
+                               self.policy.budget(kind), self.metrics, self.result_cache)
+            with self._lock:
+                self.pools[key] = pool
+                if key in self.batchers:
+                    self.batchers[key].run_batch = pool.run
+                else:
+                    # The replicas bring their own CPU budgets, so the policy's gate does not apply
+                    self.batchers[key] = MicroBatcher(pool.run, self.max_batch_size, self.max_wait, kind,
+                                                      concurrency=self.replicas)
+                return self.batchers[key]
+
+    def close(self):
+        with self._lock:
+            for pool in self.pools.values():
+                pool.close()
+
+    def _caption_batch(self, checkpoint, images):
+        trace = RequestTrace()
+        with self.models.acquire("caption", checkpoint, trace) as (processor, model):
+            captions = caption_images(processor, model, images, trace=trace)
+        self.metrics.record("caption_batch", trace, batch_size=len(images))
+        return captions
+
+    def _vqa_batch(self, checkpoint, items):
+        trace = RequestTrace()
+        with self.models.acquire("answer", checkpoint, trace) as (processor, model):
+            answers = answer_batch(processor, model, items, trace)
+        self.metrics.record("answer_batch", trace, batch_size=len(items))
+        return answers
+
+    def decode(self, kind, image_bytes):
+        # Decoding happens per request, before batching, so it is recorded on its own
+        started = time.perf_counter()
+        ingested = ingest_image_bytes(image_bytes)
+        self.metrics.observe(kind, "decode", time.perf_counter() - started)
+        return ingested.image
+
+    def caption(self, image_bytes, model=None):
+        # (caption, reuse info or None); the info is set when a near-duplicate's caption was returned.
+        # Cached results are found without loading the model
+        image_hash = hashlib.sha256(image_bytes).hexdigest()
+        params = {"max_new_tokens": MAX_NEW_TOKENS, "precision": self.models.precision("caption")}
+        checkpoint = resolve_checkpoint("caption", model)
+        caption = self.result_cache.get("caption", image_hash, checkpoint, params=params)
+        if caption is not None:
+            return caption, None
+        # Decode here, in the request's own thread, so a bad upload fails alone
+        image = self.decode("caption", image_bytes)
+        started = time.perf_counter()
+        phash = perceptual_hash(image)
+        caption, reused = reuse_near_duplicate_caption(self.result_cache, self.near_duplicates, phash, checkpoint,
+                                                       params)
+        self.metrics.observe("caption", "lookup", time.perf_counter() - started)
+        if caption is None:
+            caption = self.batcher("caption", checkpoint).submit(image)
+            self.result_cache.put("caption", image_hash, checkpoint, caption, params=params)
+            if self.near_duplicates is not None:
+                self.near_duplicates.add(image_hash, phash)
+        return caption, reused
+
+    def answer(self, image_bytes, question, model=None):
+        return self.answers(image_bytes, [question], model)[0]
+
+    def answers(self, image_bytes, questions, model=None):
+        image_hash = hashlib.sha256(image_bytes).hexdigest()
+        params = {"max_new_tokens": MAX_NEW_TOKENS, "precision": self.models.precision("answer")}
+        checkpoint = resolve_checkpoint("answer", model)
+        answers = [self.result_cache.get("answer", image_hash, checkpoint, question, params) for question in questions]
+        missing = [index for index, answer in enumerate(answers) if answer is None]
+        if missing:
+            image = self.decode("answer", image_bytes)
+            new_answers = self.batcher("answer", checkpoint).submit_many([(image, questions[index]) for index in missing])
+            for index, answer in zip(missing, new_answers):
+                answers[index] = answer
+                self.result_cache.put("answer", image_hash, checkpoint, answer, questions[index], params)
+        return answers
+
+    def health(self):
+        with self._lock:
+            batches = {f"{kind}:{checkpoint}": batcher.batches
+                       for (kind, checkpoint), batcher in self.batchers.items()}
+            pools = dict(self.pools)
+        return {
+            "status": "ok",
+            "caption_model": resolve_checkpoint("caption"),
+            "qa_model": resolve_checkpoint("answer"),
+            "execution": self.policy.describe(),
+            "models": self.models.describe(),
+            "batches": batches,
+            "replicas": {f"{kind}:{checkpoint}": pool.describe() for (kind, checkpoint), pool in pools.items()},
+        }
+
+
+class InferenceRequestHandler(BaseHTTPRequestHandler):
+    # POST /caption and POST /vqa take either the raw image bytes as the body (the question
+    # goes in the ?question= parameter) or a JSON body with "path" or base64 "image" and
+    # "question". Several questions (repeated ?question= or a JSON "questions" list) are
+    # answered together and returned as "answers". A caption taken from a near-duplicate image
+    # carries a "reused" object. A "model" parameter picks the checkpoint (a name from
+    # CAPTION_MODELS / QA_MODELS or a Hub id). GET /health reports the loaded models.
+    # GET /search?q=...&limit=... searches the caption and answer index
+    def do_GET(self):
+        url = urlparse(self.path)
+        path = url.path
+        if path == "/health":
+            self.send_json(200, self.server.service.health())
+        elif path == "/search" and self.server.service.search_index is not None:
+            query = parse_qs(url.query)
+            try:
+                limit = int(query.get("limit", [SEARCH_RESULT_LIMIT])[0])
+            except ValueError:
+                self.send_json(400, {"error": "limit must be an integer"})
+                return
+            results = self.server.service.search_index.search(query.get("q", [""])[0], limit)
+            self.send_json(200, {"results": results})
+        elif path == "/metrics":
+            body = self.server.service.metrics.prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path not in ("/caption", "/vqa"):
+            self.send_json(404, {"error": "Not found"})
+            return
+        try:
+            image_bytes, questions, model = self.read_inputs(url)
+            if url.path == "/caption":
+                caption, reused = self.server.service.caption(image_bytes, model)
+                result = {"caption": caption}
+                if reused is not None:
+                    result["reused"] = reused
+            elif not questions:
+                raise ValueError("A question is required")
+            elif len(questions) == 1:
+                result = {"answer": self.server.service.answer(image_bytes, questions[0], model)}
+            else:
+                result = {"answers": self.server.service.answers(image_bytes, questions, model)}
+        except (ValueError, KeyError, OSError, Image.DecompressionBombError) as exc:
+            self.send_json(400, {"error": str(exc)})
+            return
+        except Exception as exc:
+            self.send_json(500, {"error": str(exc)})
+            return
+        self.send_json(200, result)
+
+    def read_inputs(self, url):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        query = parse_qs(url.query)
+        questions = query.get("question", [])
+        model = query.get("model", [None])[0]
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            payload = json.loads(body)
+            if "questions" in payload:
+                questions = payload["questions"]
+            elif "question" in payload:
+                questions = [payload["question"]]
+            model = payload.get("model", model)
+            if "path" in payload:
+                with open(payload["path"], "rb") as f:
+                    return f.read(), questions, model
+            return base64.b64decode(payload["image"]), questions, model
+        return body, questions, model
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def collect_image_paths(inputs, file_list=None):
+    # Expand directories recursively and merge in an optional text file with one path per line
+    entries = list(inputs)
+    if file_list:
+        with open(file_list, encoding="utf-8") as f:
+            entries.extend(line.strip() for line in f if line.strip())
+
+    paths = []
+    seen = set()
+    for entry in entries:
+        if os.path.isdir(entry):
+            candidates = []
+            for root, dirs, files in os.walk(entry):
+                dirs.sort()
+                candidates.extend(os.path.join(root, name) for name in sorted(files)
+                                  if name.lower().endswith(IMAGE_EXTENSIONS))
+        else:
+            candidates = [entry]
+        for path in candidates:
+            path = os.path.abspath(path)
+            if path not in seen:
+                seen.add(path)
+                paths.append(path)
+    return paths
+
+
+def load_completed_paths(output_path):
+    # Collect the images already recorded in an existing JSONL output. A run killed mid-write
+    # can leave a torn last line, so the file is truncated back to the last complete record
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+
+    valid_bytes = 0
+    with open(output_path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            completed.add(record["path"])
+            valid_bytes += len(line)
+
+    if valid_bytes != os.path.getsize(output_path):
+        with open(output_path, "r+b") as f:
+            f.truncate(valid_bytes)
+    return completed
+
+
+# State of a caption-batch decode worker process, set up once by pipeline_worker_init
+pipeline_worker_state = {}
+
+
+def pipeline_worker_init(shm_name, shape, image_config, result_cache_path, checkpoint, params,
+                         near_duplicate_threshold=-1):
+    import numpy as np
+    from multiprocessing.shared_memory import SharedMemory
+
+    # Spawned workers share the parent's resource tracker, so attaching does not make them owners
+    shm = SharedMemory(name=shm_name)
+    pipeline_worker_state.update(
+        shm=shm,
+        pixels=np.ndarray(shape, dtype=np.float32, buffer=shm.buf),
+        image_config=image_config,
+        result_cache=ResultCache(result_cache_path) if result_cache_path else None,
+        near_duplicates=(NearDuplicateIndex(result_cache_path, near_duplicate_threshold)
+                         if result_cache_path and near_duplicate_threshold >= 0 else None),
+        checkpoint=checkpoint,
+        params=params,
+    )
+
+
+def pipeline_prepare_image(path, slot):
+    # Runs in a worker process: read, hash, decode and preprocess one image straight into its
+    # slot of the shared pixel buffer. Only the small result dict is pickled back
+    state = pipeline_worker_state
+    result = {"path": path, "slot": slot, "image_hash": None, "phash": None, "caption": None, "reused": None,
+              "error": None}
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        result["image_hash"] = hashlib.sha256(data).hexdigest()
+        if state["result_cache"] is not None:
+            try:
+                result["caption"] = state["result_cache"].get("caption", result["image_hash"],
+                                                              state["checkpoint"], params=state["params"])
+            except sqlite3.OperationalError:
+                pass  # The cache is locked by another writer; captioning the image is just a miss
+            if result["caption"] is not None:
+                return result
+        ingested = ingest_image_bytes(data, path, image_hash=result["image_hash"])
+        if state["near_duplicates"] is not None:
+            result["phash"] = perceptual_hash(ingested.image)
+            try:
+                result["caption"], result["reused"] = reuse_near_duplicate_caption(
+                    state["result_cache"], state["near_duplicates"], result["phash"], state["checkpoint"],
+                    state["params"])
+            except sqlite3.OperationalError:
+                pass
+            if result["caption"] is not None:
+                return result
+        preprocess_blip_image(ingested.image, state["image_config"], out=state["pixels"][slot])
+    except (OSError, ValueError, Image.DecompressionBombError) as exc:
+        result["error"] = str(exc)
+    return result
+
+
+def pipelined_captions(paths, processor, model, batch_size, workers, ordered=True, max_new_tokens=MAX_NEW_TOKENS,
+                       result_cache_path=None, params=None, prefetch_batches=PIPELINE_PREFETCH_BATCHES,
+                       near_duplicate_threshold=-1):
+    # Caption paths with a pool of worker processes decoding and preprocessing batches ahead
+    # of the model. Pixels travel through a shared-memory buffer of prefetch_batches blocks of
+    # batch_size slots; a block is only handed out again once the model is done with it, which
+    # bounds memory and blocks the workers when the model falls behind. Yields one result dict
+    # per path: in input order, or batch by batch as batches become ready if ordered is False
+    import numpy as np
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+    from multiprocessing import get_context
+    from multiprocessing.shared_memory import SharedMemory
+
+    image_config = image_processor_config(processor)
+    shape = (prefetch_batches * batch_size, 3, image_config["size"]["height"], image_config["size"]["width"])
+    shm = SharedMemory(create=True, size=int(np.prod(shape)) * 4)
+    pixels = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+    # spawn rather than fork: the parent may already be running torch's thread pools
+    executor = ProcessPoolExecutor(workers, mp_context=get_context("spawn"), initializer=pipeline_worker_init,
+                                   initargs=(shm.name, shape, image_config, result_cache_path,
+                                             model.name_or_path, params, near_duplicate_threshold))
+    path_iter = iter(paths)
+    free_blocks = list(range(prefetch_batches))
+    in_flight = []
+
+    def fill():
+        while free_blocks:
+            chunk = list(itertools.islice(path_iter, batch_size))
+            if not chunk:
+                return
+            block = free_blocks.pop(0)
+            futures = [executor.submit(pipeline_prepare_image, path, block * batch_size + index)
+                       for index, path in enumerate(chunk)]
+            in_flight.append((block, futures))
+
+    try:
+        fill()
+        while in_flight:
+            if ordered:
+                entry = in_flight[0]
+                wait(entry[1])
+            else:
+                while not any(all(future.done() for future in futures) for _, futures in in_flight):
+                    wait([future for _, futures in in_flight for future in futures], return_when=FIRST_COMPLETED)
+                entry = next(item for item in in_flight if all(future.done() for future in item[1]))
+            in_flight.remove(entry)
+            block, futures = entry
+            results = [future.result() for future in futures]
+
+            to_caption = [result for result in results if result["caption"] is None and result["error"] is None]
+            batch = None
+            if to_caption:
+                slots = [result["slot"] for result in to_caption]
+                if slots == list(range(slots[0], slots[0] + len(slots))):
+                    batch = pixels[slots[0]:slots[0] + len(slots)]  # A view, no copy
+                else:
+                    batch = pixels[slots]  # Some images were cached or unreadable
+                captions = caption_pixel_values(processor, model, batch, max_new_tokens)
+                for result, caption in zip(to_caption, captions):
+                    result["caption"] = caption
+                    result["generated"] = True
+            del batch
+            free_blocks.append(block)
+            fill()
+            yield from results
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        del pixels
+        shm.close()
+        shm.unlink()
+
+
+def run_batch_captioning(args):
+    paths = collect_image_paths(args.inputs, args.file_list)
+    completed = load_completed_paths(args.output)
+    pending = [path for path in paths if path not in completed]
+    print(f"{len(paths)} images found, {len(paths) - len(pending)} already captioned, "
+          f"{len(pending)} to caption", file=sys.stderr)
+    if not pending:
+        return 0
+
+    processor, model = load_caption_model(args.snapshot, args.precision, args.backend, name=args.model)
+    result_cache = None if args.no_result_cache else ResultCache(args.result_cache)
+    if result_cache is not None:
+        result_cache.sync_checkpoint(model.name_or_path, checkpoint_revision(model))
+    params = {"max_new_tokens": args.max_new_tokens, "precision": model_precision(model)}
+    near_duplicates = (NearDuplicateIndex(args.result_cache, args.near_duplicate_threshold)
+                       if result_cache is not None and args.near_duplicate_threshold >= 0 else None)
+
+    if args.workers > 0:
+        return run_pipelined_captioning(args, pending, processor, model, result_cache, params, near_duplicates)
+
+    with open(args.output, "a", encoding="utf-8") as out:
+        for start in range(0, len(pending), args.batch_size):
+            batch_paths = []
+            batch_hashes = []
+            batch_phashes = []
+            images = []
+            for path in pending[start:start + args.batch_size]:
+                try:
+                    # Read once for both the content hash, recorded for search-index, and the decode
+                    with open(path, "rb") as f:
+                        data = f.read()
+                    image_hash = hashlib.sha256(data).hexdigest()
+                    caption = (result_cache.get("caption", image_hash, model.name_or_path, params=params)
+                               if result_cache is not None else None)
+                    if caption is not None:
+                        out.write(json.dumps({"path": path, "image_hash": image_hash, "caption": caption}) + "\n")
+                        continue
+                    image = ingest_image_bytes(data, path, image_hash=image_hash).image
+                    phash = perceptual_hash(image) if near_duplicates is not None else None
+                    caption, reused = reuse_near_duplicate_caption(result_cache, near_duplicates, phash,
+                                                                   model.name_or_path, params)
+                    if caption is not None:
+                        out.write(json.dumps({"path": path, "image_hash": image_hash, "caption": caption,
+                                              "reused": reused}) + "\n")
+                        continue
+                    images.append(image)
+                    batch_paths.append(path)
+                    batch_hashes.append(image_hash)
+                    batch_phashes.append(phash)
+                except (OSError, ValueError, Image.DecompressionBombError) as exc:
+                    # Unreadable files are recorded so a resumed run does not retry them forever
+                    out.write(json.dumps({"path": path, "error": str(exc)}) + "\n")
+
+            if images:
+                captions = caption_images(processor, model, images, args.max_new_tokens)
+                for path, image_hash, phash, caption in zip(batch_paths, batch_hashes, batch_phashes, captions):
+                    out.write(json.dumps({"path": path, "image_hash": image_hash, "caption": caption}) + "\n")
+                    if result_cache is not None:
+                        result_cache.put("caption", image_hash, model.name_or_path, caption, params=params)
+                    if near_duplicates is not None:
+                        near_duplicates.add(image_hash, phash)
+
+            # Flush per batch so an interrupted run loses at most the batch in flight
+            out.flush()
+            print(f"{min(start + args.batch_size, len(pending))}/{len(pending)} captioned", file=sys.stderr)
+    return 0
+
+
+def run_ask(args):
+    questions = list(args.question or [])
+    if args.questions_file:
+        with open(args.questions_file, encoding="utf-8") as f:
+            questions.extend(split_questions(f.read()))
+    if not questions:
+        print("No questions given; use --question or --questions-file", file=sys.stderr)
+        return 2
+
+    processor, model = load_qa_model(args.snapshot, args.precision, args.backend, name=args.model)
+    result_cache = None if args.no_result_cache else ResultCache(args.result_cache)
+    if result_cache is not None:
+        result_cache.sync_checkpoint(model.name_or_path, checkpoint_revision(model))
+
+    out = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    try:
+        for path in collect_image_paths(args.inputs, args.file_list):
+            try:
+                # Read and decode once for both the content hash, recorded for search-index, and the model
+                ingested = ingest_image(path)
+                answers = answer_image_questions(processor, model, path, questions, result_cache=result_cache,
+                                                 max_new_tokens=args.max_new_tokens, ingested=ingested)
+            except (OSError, ValueError, Image.DecompressionBombError) as exc:
+                out.write(json.dumps({"path": path, "error": str(exc)}) + "\n")
+                continue
+            for question, answer in zip(questions, answers):
+                out.write(json.dumps({"path": path, "image_hash": ingested.image_hash, "question": question,
+                                      "answer": answer}) + "\n")
+            out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 0
+
+
+def run_caption_sequence(args):
+    if args.format == "vtt" and len(args.inputs) != 1:
+        print("--format vtt writes the track of a single sequence", file=sys.stderr)
+        return 2
+    processor, model = load_caption_model(args.snapshot, args.precision, args.backend, name=args.model)
+    result_cache = None if args.no_result_cache else ResultCache(args.result_cache)
+    if result_cache is not None:
+        result_cache.sync_checkpoint(model.name_or_path, checkpoint_revision(model))
+
+    out = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    try:
+        for path in args.inputs:
+            # Recorded absolute, so search-index finds the file from any working directory
+            path = os.path.abspath(path)
+            try:
+                image_hash = None if os.path.isdir(path) else hash_image_file(path)
+                result = caption_sequence(processor, model, path, result_cache, args.change_threshold, args.fps,
+                                          args.batch_size, args.max_new_tokens)
+            except (OSError, ValueError, Image.DecompressionBombError) as exc:
+                if args.format == "vtt":
+                    print(f"Could not caption {path}: {exc}", file=sys.stderr)
+                    return 1
+                out.write(json.dumps({"path": path, "error": str(exc)}) + "\n")
+                continue
+            print(f"{path}: {result['keyframes']} of {result['frames']} frames captioned", file=sys.stderr)
+            if args.format == "vtt":
+                out.write(caption_track_vtt(result["track"]))
+            else:
+                out.write(json.dumps(dict({"path": path, "image_hash": image_hash}, **result)) + "\n")
+                out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 0
+
+
+def run_caption_tiled(args):
+    if not 0 <= args.overlap < 1 or args.tile_size < 1 or args.max_tiles < 1:
+        print("--overlap must be in [0, 1), --tile-size and --max-tiles positive", file=sys.stderr)
+        return 2
+    processor, model = load_caption_model(args.snapshot, args.precision, args.backend, name=args.model)
+    result_cache = None if args.no_result_cache else ResultCache(args.result_cache)
+    if result_cache is not None:
+        result_cache.sync_checkpoint(model.name_or_path, checkpoint_revision(model))
+
+    out = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    try:
+        for path in collect_image_paths(args.inputs, args.file_list):
+            started = time.perf_counter()
+            try:
+                # Read once for both the content hash, recorded for search-index, and the captions
+                with open(path, "rb") as f:
+                    data = f.read()
+                image_hash = hashlib.sha256(data).hexdigest()
+                result = caption_tiles(processor, model, path, result_cache, args.tile_size, args.overlap,
+                                       args.max_tiles, args.max_new_tokens, data=data, image_hash=image_hash)
+            except (OSError, ValueError, Image.DecompressionBombError) as exc:
+                out.write(json.dumps({"path": path, "error": str(exc)}) + "\n")
+                continue
+            print(f"{path}: {len(result['regions'])} regions in {time.perf_counter() - started:.2f}s",
+                  file=sys.stderr)
+            out.write(json.dumps(dict({"path": path, "image_hash": image_hash}, **result)) + "\n")
+            out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 0
+
+
+def run_pipelined_captioning(args, pending, processor, model, result_cache, params, near_duplicates):
+    result_cache_path = None if args.no_result_cache else args.result_cache
+    threshold = near_duplicates.threshold if near_duplicates is not None else -1
+    done = 0
+    with open(args.output, "a", encoding="utf-8") as out:
+        for result in pipelined_captions(pending, processor, model, args.batch_size, args.workers,
+                                         not args.unordered, args.max_new_tokens, result_cache_path, params,
+                                         near_duplicate_threshold=threshold):
+            if result["error"] is not None:
+                out.write(json.dumps({"path": result["path"], "error": result["error"]}) + "\n")
+            elif result["reused"] is not None:
+                out.write(json.dumps({"path": result["path"], "image_hash": result["image_hash"],
+                                      "caption": result["caption"], "reused": result["reused"]}) + "\n")
+            else:
+                out.write(json.dumps({"path": result["path"], "image_hash": result["image_hash"],
+                                      "caption": result["caption"]}) + "\n")
+                if result.get("generated") and result_cache is not None:
+                    result_cache.put("caption", result["image_hash"], model.name_or_path, result["caption"],
+                                     params=params)
+                if result.get("generated") and near_duplicates is not None:
+                    near_duplicates.add(result["image_hash"], result["phash"])
+            done += 1
+            if done % args.batch_size == 0 or done == len(pending):
+                # Flush per batch so an interrupted run loses at most the batches in flight
+                out.flush()
+                print(f"{done}/{len(pending)} captioned", file=sys.stderr)
+    return 0
+
+
+def run_search_index(args):
+    search_index = SearchIndex(args.search_index)
+    status = 0
+    for path in args.inputs:
+        started = time.perf_counter()
+        try:
+            lines = search_index.ingest_jsonl(path)
+        except OSError as exc:
+            print(f"Could not index {path}: {exc}", file=sys.stderr)
+            status = 1
+            continue
+        print(f"{path}: {lines} new lines indexed in {time.perf_counter() - started:.2f}s", file=sys.stderr)
+    print(f"{search_index.count()} captions and answers indexed", file=sys.stderr)
+    return status
+
+
+def run_search(args):
+    started = time.perf_counter()
+    results = SearchIndex(args.search_index).search(" ".join(args.query), args.limit)
+    for result in results:
+        print(json.dumps(result))
+    print(f"{len(results)} images in {(time.perf_counter() - started) * 1000:.1f} ms", file=sys.stderr)
+    return 0
+
+
+def run_cache_invalidate(args):
+    removed = ResultCache(args.result_cache).invalidate(args.checkpoint)
+    print(f"Removed {removed} cached results", file=sys.stderr)
+    return 0
+
+
+def run_startup_probe(args):
+    # Runs in a fresh interpreter for measure-startup: loads what a launch has to load before the
+    # window is usable and reports the time spent and the peak resident set size
+    import resource
+
+    started = time.perf_counter()
+    load_caption_model(args.snapshot)
+    if args.mode == "eager":
+        load_qa_model(args.snapshot)
+    print(json.dumps({
+        "load_seconds": time.perf_counter() - started,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }))
+    return 0
+
+
+def run_measure_startup(args):
+    # "eager" is the previous behaviour (both checkpoints through from_pretrained at startup),
+    # "lazy" loads only the captioner, optionally from the memory-mapped snapshot
+    import statistics
+    import subprocess
+
+    configurations = [("eager", False), ("lazy", False), ("lazy", True)]
+    for mode, snapshot in configurations:
+        command = [sys.executable, os.path.abspath(__file__), "startup-probe", "--mode", mode]
+        if snapshot:
+            command.append("--snapshot")
+            # The first snapshot launch writes the snapshot; only steady-state launches are measured
+            subprocess.run(command, check=True, capture_output=True)
+
+        wall_times = []
+        probes = []
+        for _ in range(args.runs):
+            started = time.perf_counter()
+            output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+            wall_times.append(time.perf_counter() - started)
+            probes.append(json.loads(output.strip().splitlines()[-1]))
+
+        label = mode + (" + snapshot" if snapshot else "")
+        print(f"{label:16s} startup {statistics.median(wall_times):6.2f}s  "
+              f"model load {statistics.median(p['load_seconds'] for p in probes):6.2f}s  "
+              f"peak RSS {max(p['peak_rss_mb'] for p in probes):8.1f} MB")
+    return 0
+
+
+def build_tiny_blip_checkpoints(root):
+    # Randomly initialised BLIP models with a made-up vocabulary, small enough to build in a
+    # second without network access. They keep the real 384px input so that decoding and
+    # preprocessing cost the same as with the real checkpoints; only the transformer is tiny
+    import torch
+    import transformers
+
+    vocab = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", "[DEC]"] + [f"word{i}" for i in range(250)]
+    vocab_path = os.path.join(root, "vocab.txt")
+    with open(vocab_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(vocab) + "\n")
+    tokenizer = transformers.BertTokenizerFast(vocab_file=vocab_path, bos_token="[DEC]")
+    image_processor = transformers.BlipImageProcessor(size={"height": 384, "width": 384})
+    processor = transformers.BlipProcessor(image_processor, tokenizer)
+    config = transformers.BlipConfig(
+        vision_config=dict(hidden_size=64, intermediate_size=128, num_hidden_layers=2, num_attention_heads=2,
+                           image_size=384, patch_size=32),
+        text_config=dict(vocab_size=len(vocab), hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+                         num_attention_heads=2, encoder_hidden_size=64, max_position_embeddings=128,
+                         bos_token_id=vocab.index("[DEC]"), pad_token_id=vocab.index("[PAD]"),
+                         sep_token_id=vocab.index("[SEP]"), eos_token_id=vocab.index("[SEP]")),
+    )
+
+    torch.manual_seed(0)
+    checkpoints = []
+    for name, model_class in (("caption", transformers.BlipForConditionalGeneration),
+                              ("vqa", transformers.BlipForQuestionAnswering)):
+        checkpoint = os.path.join(root, name)
+        model_class(config).eval().save_pretrained(checkpoint)
+        processor.save_pretrained(checkpoint)
+        checkpoints.append(checkpoint)
+    return checkpoints
+
+
+def make_benchmark_images(root, sizes=BENCHMARK_IMAGE_SIZES):
+    # Synthetic JPEG photos (two gradients and a noise channel) so decoding cost is realistic
+    paths = []
+    for width, height in sizes:
+        channels = (
+            Image.linear_gradient("L").resize((width, height)),
+            Image.linear_gradient("L").rotate(90).resize((width, height)),
+            Image.effect_noise((width, height), 40),
+        )
+        path = os.path.join(root, f"benchmark_{width}x{height}.jpg")
+        Image.merge("RGB", channels).save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def summarize_timings(samples):
+    import statistics
+
+    return {
+        "median": statistics.median(samples),
+        "mean": statistics.fmean(samples),
+        "min": min(samples),
+        "max": max(samples),
+        "runs": len(samples),
+    }
+
+
+def time_call(function, repeat):
+    # One untimed warm-up call, then repeat timed calls
+    function()
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - started)
+    return summarize_timings(samples)
+
+
+def run_benchmark(args):
+    import platform
+    import resource
+    import tempfile
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": {
+            "tiny": args.tiny,
+            "backend": args.backend,
+            "precision": args.precision,
+            "max_new_tokens": args.max_new_tokens,
+            "repeat": args.repeat,
+            "batch_sizes": args.batch_sizes,
+        },
+        "stages": {},
+        "throughput": {},
+    }
+    stages = report["stages"]
+
+    started = time.perf_counter()
+    import torch
+    import transformers
+
+    stages["import"] = summarize_timings([time.perf_counter() - started])
+    report["torch"] = torch.__version__
+    report["transformers"] = transformers.__version__
+
+    with tempfile.TemporaryDirectory() as workdir:
+        if args.tiny:
+            caption_checkpoint, qa_checkpoint = build_tiny_blip_checkpoints(workdir)
+        else:
+            caption_checkpoint, qa_checkpoint = CAPTION_CHECKPOINT, QA_CHECKPOINT
+        report["config"]["checkpoints"] = [os.path.basename(caption_checkpoint) if args.tiny else caption_checkpoint,
+                                           os.path.basename(qa_checkpoint) if args.tiny else qa_checkpoint]
+        image_paths = collect_image_paths(args.images) if args.images else make_benchmark_images(workdir)
+
+        # Model load, as done by CaptionModelLoader and QAModelLoader
+        load = lambda checkpoint, model_class: load_blip_checkpoint(checkpoint, model_class, precision=args.precision,
+                                                                    backend=args.backend)
+        stages["load_caption_model"] = time_call(
+            lambda: load(caption_checkpoint, "BlipForConditionalGeneration"), args.repeat)
+        stages["load_qa_model"] = time_call(lambda: load(qa_checkpoint, "BlipForQuestionAnswering"), args.repeat)
+        caption_processor, caption_model = load(caption_checkpoint, "BlipForConditionalGeneration")
+        qa_processor, qa_model = load(qa_checkpoint, "BlipForQuestionAnswering")
+
+        for path in image_paths:
+            ingested = ingest_image(path)
+            image = ingested.image
+            label = "x".join(str(side) for side in ingested.original_size)
+            stages[f"decode_{label}"] = time_call(lambda: ingest_image(path), args.repeat)
+            stages[f"preprocess_{label}"] = time_call(
+                lambda: caption_processor(images=image, return_tensors="np" if args.backend == "onnx" else "pt"),
+                args.repeat)
+            stages[f"caption_end_to_end_{label}"] = time_call(
+                lambda: caption_images(caption_processor, caption_model, [ingest_image(path).image],
+                                       args.max_new_tokens), args.repeat)
+            stages[f"vqa_end_to_end_{label}"] = time_call(
+                lambda: answer_from_image_embeds(qa_processor, qa_model,
+                                                 encode_image(qa_processor, qa_model, ingest_image(path).image),
+                                                 BENCHMARK_QUESTION, args.max_new_tokens), args.repeat)
+
+        # Generation alone, from already preprocessed inputs
+        image = ingest_image(image_paths[0]).image
+        if args.backend == "onnx":
+            pixel_values = caption_processor(images=image, return_tensors="np")["pixel_values"]
+            generate = lambda: caption_model.generate(caption_model.encode_image(pixel_values),
+                                                      max_new_tokens=args.max_new_tokens)
+        else:
+            inputs = caption_processor(images=image, return_tensors="pt")
+            inputs["pixel_values"] = inputs["pixel_values"].to(caption_model.dtype)
+
+            def generate():
+                with torch.inference_mode():
+                    caption_model.generate(**inputs, max_new_tokens=args.max_new_tokens)
+        stages["caption_generate"] = time_call(generate, args.repeat)
+        image_embeds = encode_image(qa_processor, qa_model, image)
+        stages["vqa_encode_image"] = time_call(lambda: encode_image(qa_processor, qa_model, image), args.repeat)
+        stages["vqa_answer"] = time_call(
+            lambda: answer_from_image_embeds(qa_processor, qa_model, image_embeds, BENCHMARK_QUESTION,
+                                             args.max_new_tokens), args.repeat)
+
+        # Captioning throughput when images are generated together
+        for batch_size in args.batch_sizes:
+            batch = [image] * batch_size
+            timings = time_call(lambda: caption_images(caption_processor, caption_model, batch, args.max_new_tokens),
+                                args.repeat)
+            report["throughput"][f"caption_batch_{batch_size}"] = dict(
+                timings, images_per_second=batch_size / timings["median"])
+
+        if args.tiny and args.backend == "onnx":
+            # The exports of the throwaway models would otherwise pile up in the export cache
+            import shutil
+
+            for checkpoint in (caption_checkpoint, qa_checkpoint):
+                shutil.rmtree(onnx_dir_for(checkpoint), ignore_errors=True)
+
+    report["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    for name, timings in report["stages"].items():
+        print(f"{name:40s} {timings['median'] * 1000:10.1f} ms", file=sys.stderr)
+    for name, timings in report["throughput"].items():
+        print(f"{name:40s} {timings['images_per_second']:10.1f} images/s", file=sys.stderr)
+    print(f"{'peak RSS':40s} {report['peak_rss_mb']:10.1f} MB", file=sys.stderr)
+
+    if args.baseline:
+        return compare_benchmarks(args.baseline, report, args.tolerance)
+    return 0
+
+
+def compare_benchmarks(baseline_path, report, tolerance):
+    # Non-zero exit status if any stage's median got slower than the baseline by more than tolerance
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    regressions = 0
+    for section in ("stages", "throughput"):
+        for name, timings in report[section].items():
+            previous = baseline.get(section, {}).get(name)
+            if previous is None:
+                continue
+            ratio = timings["median"] / previous["median"]
+            flag = ""
+            if ratio > 1 + tolerance:
+                flag = "  REGRESSION"
+                regressions += 1
+            print(f"{name:40s} {ratio:6.2f}x baseline{flag}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+def run_precision_probe(args):
+    # Runs in a fresh interpreter for compare-precision, so each mode's memory is measured alone
+    import resource
+
+    images = []
+    for path in collect_image_paths(args.inputs):
+        try:
+            images.append(Image.open(path).convert('RGB'))
+        except OSError:
+            continue
+        if len(images) == args.limit:
+            break
+    if not images:
+        print("None of the inputs could be read as an image", file=sys.stderr)
+        return 1
+    questions = args.question or [BENCHMARK_QUESTION]
+
+    if args.task == "caption":
+        processor, model = load_caption_model(precision=args.precision, name=args.model)
+        run_one = lambda image: caption_images(processor, model, [image], args.max_new_tokens)
+    else:
+        processor, model = load_qa_model(precision=args.precision, name=args.model)
+        run_one = lambda image: [
+            answer_from_image_embeds(processor, model, encode_image(processor, model, image), question,
+                                     args.max_new_tokens)
+            for question in questions
+        ]
+    # From the weights rather than the RSS, which also counts the libraries imported while loading
+    # and leaves out memory-mapped weights until they are first read
+    model_mb = model_memory_bytes(model) / (1024 * 1024)
+
+    run_one(images[0])  # Warm-up, not timed
+    outputs = []
+    latencies = []
+    for image in images:
+        started = time.perf_counter()
+        outputs.extend(run_one(image))
+        latencies.append(time.perf_counter() - started)
+
+    print(json.dumps({
+        "outputs": outputs,
+        "latencies": latencies,
+        "model_mb": model_mb,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }))
+    return 0
+
+
+def run_compare_precision(args):
+    # Latency, memory and output agreement of each precision mode against fp32 on local images
+    import statistics
+    import subprocess
+
+    if args.model and args.task == "both":
+        print("--model needs --task caption or --task vqa", file=sys.stderr)
+        return 2
+    if not collect_image_paths(args.inputs):
+        print("No images found", file=sys.stderr)
+        return 1
+
+    tasks = ["caption", "vqa"] if args.task == "both" else [args.task]
+    for task in tasks:
+        reference = None
+        for precision in ("fp32",) + tuple(mode for mode in args.modes if mode != "fp32"):
+            command = [sys.executable, os.path.abspath(__file__), "precision-probe", *args.inputs,
+                       "--task", task, "--precision", precision, "--limit", str(args.limit),
+                       "--max-new-tokens", str(args.max_new_tokens)]
+            if args.model:
+                command += ["--model", args.model]
+            for question in args.question or []:
+                command += ["--question", question]
+            probe_run = subprocess.run(command, capture_output=True, text=True)
+            if probe_run.returncode != 0:
+                print(f"{task} {precision} probe failed:\n{probe_run.stderr.strip()}", file=sys.stderr)
+                return 1
+            probe = json.loads(probe_run.stdout.strip().splitlines()[-1])
+            if reference is None:
+                reference = probe["outputs"]
+            agreement = sum(a == b for a, b in zip(probe["outputs"], reference)) / len(reference)
+            print(f"{task:8s} {precision:5s} latency {statistics.mean(probe['latencies']) * 1000:8.1f} ms/image  "
+                  f"model {probe['model_mb']:8.1f} MB  peak RSS {probe['peak_rss_mb']:8.1f} MB  "
+                  f"agreement with fp32 {agreement:6.1%}")
+    return 0
+
+
+def run_export_onnx(args):
+    # Export (or reuse) the ONNX graphs and, given images, check them against the torch models
+    if args.model and args.task == "both":
+        print("--model needs --task caption or --task vqa", file=sys.stderr)
+        return 2
+    tasks = ["caption", "vqa"] if args.task == "both" else [args.task]
+    images = []
+    for path in collect_image_paths(args.verify):
+        try:
+            images.append(Image.open(path).convert('RGB'))
+        except OSError:
+            continue
+    questions = args.question or [BENCHMARK_QUESTION]
+
+    mismatches = 0
+    for task in tasks:
+        kind = "caption" if task == "caption" else "answer"
+        checkpoint = resolve_checkpoint(kind, args.model)
+        model_class_name = ModelRegistry.MODEL_CLASSES[kind]
+        export_dir = export_onnx(checkpoint, model_class_name, force=args.force)
+        print(f"{task}: ONNX export in {export_dir}", file=sys.stderr)
+        if not images:
+            continue
+
+        import numpy as np
+
+        torch_processor, torch_model = load_blip_checkpoint(checkpoint, model_class_name)
+        onnx_processor, onnx_model = load_blip_checkpoint(checkpoint, model_class_name, backend="onnx")
+        max_diff = 0.0
+        agreeing = 0
+        total = 0
+        for image in images:
+            torch_embeds = encode_image(torch_processor, torch_model, image)
+            onnx_embeds = encode_image(onnx_processor, onnx_model, image)
+            max_diff = max(max_diff, float(np.abs(torch_embeds.numpy() - onnx_embeds).max()))
+            if task == "caption":
+                pairs = [(caption_images(torch_processor, torch_model, [image], args.max_new_tokens)[0],
+                          caption_images(onnx_processor, onnx_model, [image], args.max_new_tokens)[0])]
+            else:
+                pairs = [(answer_from_image_embeds(torch_processor, torch_model, torch_embeds, question,
+                                                   args.max_new_tokens),
+                          answer_from_image_embeds(onnx_processor, onnx_model, onnx_embeds, question,
+                                                   args.max_new_tokens))
+                         for question in questions]
+            for torch_text, onnx_text in pairs:
+                total += 1
+                agreeing += torch_text == onnx_text
+                if torch_text != onnx_text:
+                    print(f"  mismatch: torch {torch_text!r} vs onnx {onnx_text!r}", file=sys.stderr)
+
+        mismatches += total - agreeing + (max_diff > args.tolerance)
+        print(f"{task}: max |torch - onnx| image embedding {max_diff:.2e}, "
+              f"identical outputs {agreeing}/{total}")
+    return 1 if mismatches else 0
+
+
+def run_server(args):
+    if args.replicas and args.backend != "torch":
+        print("--replicas share memory-mapped torch snapshots and need --backend torch", file=sys.stderr)
+        return 2
+    policy = ExecutionPolicy(args.thread_policy, pin=args.pin_cores)
+    result_cache = ResultCache(args.result_cache)
+    models = ModelRegistry(args.model_memory_mb * 1024 * 1024, args.model_idle_timeout, args.snapshot,
+                           {"caption": args.caption_precision, "answer": args.qa_precision}, args.backend, policy,
+                           result_cache)
+    metrics = StageMetrics(args.metrics_jsonl, args.metrics_prom)
+    near_duplicates = (NearDuplicateIndex(args.result_cache, args.near_duplicate_threshold)
+                       if args.near_duplicate_threshold >= 0 else None)
+    service = InferenceService(models, result_cache, args.max_batch_size, args.max_wait_ms / 1000, metrics,
+                               policy, near_duplicates, SearchIndex(args.search_index), args.replicas)
+    # The default models are loaded up front so the first requests do not wait for them
+    if args.replicas:
+        service.batcher("caption", resolve_checkpoint("caption"))
+        service.batcher("answer", resolve_checkpoint("answer"))
+    else:
+        models.preload("caption")
+        models.preload("answer")
+        policy.apply_process_settings()
+
+    server = ThreadingHTTPServer((args.host, args.port), InferenceRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    print(f"Execution: {policy.describe()}", file=sys.stderr)
+    print(f"Serving on http://{args.host}:{args.port}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+    return 0
+
+
+def run_gui(args):
     app = QApplication(sys.argv)
-    window = MainWindow()
+    window = MainWindow(args)
     window.resize(1200, 800)  # Adjust window size as needed
     window.show()
-    sys.exit(app.exec())
+    return app.exec()
+
+
+def build_arg_parser():
+    # No abbreviations: the window's --model-* options would otherwise capture the subcommands' --model
+    parser = argparse.ArgumentParser(description="Image Caption Generator and Q&A", allow_abbrev=False)
+    parser.add_argument("--snapshot", action="store_true",
+                        help="Load models from (and create) memory-mapped weight snapshots")
+    parser.add_argument("--caption-precision", choices=PRECISION_MODES, default="fp32",
+                        help="Inference precision of the captioning model")
+    parser.add_argument("--qa-precision", choices=PRECISION_MODES, default="fp32",
+                        help="Inference precision of the VQA model")
+    parser.add_argument("--backend", choices=BACKENDS, default="torch",
+                        help="Run the models with PyTorch or with ONNX Runtime (exported on first use)")
+    parser.add_argument("--session-store", default=SESSION_STORE_PATH,
+                        help="SQLite file the window's sessions are saved to")
+    parser.add_argument("--thread-policy", choices=THREAD_POLICIES, default="default",
+                        help="How the caption and VQA models share the CPU cores")
+    parser.add_argument("--pin-cores", action="store_true",
+                        help="With the throughput policy, bind each model to its own cores")
+    parser.add_argument("--metrics-jsonl", metavar="PATH", help="Append the stage timings of every request to this file")
+    parser.add_argument("--metrics-prom", metavar="PATH",
+                        help="Keep a Prometheus text file with per-stage latency histograms up to date")
+    parser.add_argument("--near-duplicate-threshold", type=int, default=NEAR_DUPLICATE_THRESHOLD,
+                        help="Reuse the caption of an image whose perceptual hash differs in at most this many "
+                             "bits (-1: never)")
+    parser.add_argument("--model-memory-mb", type=int, default=MODEL_MEMORY_BUDGET_MB,
+                        help="Memory for loaded models; least recently used models are unloaded beyond it")
+    parser.add_argument("--model-idle-timeout", type=float, default=MODEL_IDLE_TIMEOUT,
+                        help="Seconds after which an unused model is unloaded (0: never)")
+    parser.add_argument("--search-index", default=SEARCH_INDEX_PATH,
+                        help="SQLite file the shown captions and answers are indexed in for searching")
+    parser.add_argument("--server", metavar="URL",
+                        help="Use a running `serve` process (e.g. http://127.0.0.1:8765) instead of local models")
+    parser.set_defaults(func=run_gui)
+    subparsers = parser.add_subparsers(dest="command")
+
+    batch_parser = subparsers.add_parser("caption-batch", help="Caption images headlessly and write JSONL")
+    batch_parser.add_argument("inputs", nargs="*", help="Image files or directories to caption")
+    batch_parser.add_argument("--file-list", help="Text file with one image path per line")
+    batch_parser.add_argument("-o", "--output", required=True,
+                              help="JSONL output file; an existing file is resumed")
+    batch_parser.add_argument("--batch-size", type=int, default=8, help="Images per generate call")
+    batch_parser.add_argument("--max-new-tokens", type=int, default=MAX_NEW_TOKENS)
+    batch_parser.add_argument("--result-cache", default=RESULT_CACHE_PATH, help="SQLite result cache file")
+    batch_parser.add_argument("--no-result-cache", action="store_true", help="Always run the model")
+    batch_parser.add_argument("--near-duplicate-threshold", type=int, default=NEAR_DUPLICATE_THRESHOLD,
+                              help="Reuse the caption of an image whose perceptual hash differs in at most this "
+                                   "many bits (-1: never)")
+    batch_parser.add_argument("--snapshot", action="store_true",
+                              help="Load the model from (and create) a memory-mapped weight snapshot")
+    batch_parser.add_argument("--precision", choices=PRECISION_MODES, default="fp32",
+                              help="Inference precision of the captioning model")
+    batch_parser.add_argument("--model", help=f"Model name ({', '.join(CAPTION_MODELS)}) or Hub id "
+                                              f"(default: {CAPTION_CHECKPOINT})")
+    batch_parser.add_argument("--backend", choices=BACKENDS, default="torch",
+                              help="Run the model with PyTorch or with ONNX Runtime")
+    batch_parser.add_argument("--workers", type=int, default=0,
+                              help="Processes decoding and preprocessing images ahead of the model (0: inline)")
+    batch_parser.add_argument("--unordered", action="store_true",
+                              help="With --workers, write batches as they finish instead of in input order")
+    batch_parser.set_defaults(func=run_batch_captioning)
+
+    sequence_parser = subparsers.add_parser(
+        "caption-sequence", help="Caption the changing frames of animated images or frame folders as a track")
+    sequence_parser.add_argument("inputs", nargs="+", help="Animated GIF/PNG/WebP files or folders of numbered frames")
+    sequence_parser.add_argument("-o", "--output", help="Output file (default: standard output)")
+    sequence_parser.add_argument("--format", choices=["jsonl", "vtt"], default="jsonl",
+                                 help="One JSON line per sequence, or a WebVTT caption track of a single sequence")
+    sequence_parser.add_argument("--change-threshold", type=float, default=SEQUENCE_CHANGE_THRESHOLD,
+                                 help="Mean pixel difference (0-1) from the last captioned frame at which a frame "
+                                      "is captioned again")
+    sequence_parser.add_argument("--fps", type=float, default=SEQUENCE_FOLDER_FPS,
+                                 help="Frame rate of frame folders (animated files carry their own timing)")
+    sequence_parser.add_argument("--batch-size", type=int, default=8, help="Keyframes per generate call")
+    sequence_parser.add_argument("--max-new-tokens", type=int, default=MAX_NEW_TOKENS)
+    sequence_parser.add_argument("--result-cache", default=RESULT_CACHE_PATH, help="SQLite result cache file")
+    sequence_parser.add_argument("--no-result-cache", action="store_true", help="Always run the model")
+    sequence_parser.add_argument("--snapshot", action="store_true",
+                                 help="Load the model from (and create) a memory-mapped weight snapshot")
+    sequence_parser.add_argument("--precision", choices=PRECISION_MODES, default="fp32",
+                                 help="Inference precision of the captioning model")
+    sequence_parser.add_argument("--model", help=f"Model name ({', '.join(CAPTION_MODELS)}) or Hub id "
+                                                 f"(default: {CAPTION_CHECKPOINT})")
+    sequence_parser.add_argument("--backend", choices=BACKENDS, default="torch",
+                                 help="Run the model with PyTorch or with ONNX Runtime")
+    sequence_parser.set_defaults(func=run_caption_sequence)
+
+    tiled_parser = subparsers.add_parser(
+        "caption-tiled", help="Caption large images as a whole and by overlapping regions, as JSONL")
+    tiled_parser.add_argument("inputs", nargs="*", help="Image files or directories")
+    tiled_parser.add_argument("--file-list", help="Text file with one image path per line")
+    tiled_parser.add_argument("-o", "--output", help="JSONL output file (default: standard output)")
+    tiled_parser.add_argument("--tile-size", type=int, default=TILE_SIZE,
+                              help="Side of a region in pixels of the original image; larger when more than "
+                                   "--max-tiles regions would be needed")
+    tiled_parser.add_argument("--overlap", type=float, default=TILE_OVERLAP,
+                              help="Fraction of a region shared with each neighbour")
+    tiled_parser.add_argument("--max-tiles", type=int, default=TILE_MAX_COUNT,
+                              help="Most regions per image, all captioned in one batch with the whole image")
+    tiled_parser.add_argument("--max-new-tokens", type=int, default=MAX_NEW_TOKENS)
+    tiled_parser.add_argument("--result-cache", default=RESULT_CACHE_PATH, help="SQLite result cache file")
+    tiled_parser.add_argument("--no-result-cache", action="store_true", help="Always run the model")
+    tiled_parser.add_argument("--snapshot", action="store_true",
+                              help="Load the model from (and create) a memory-mapped weight snapshot")
+    tiled_parser.add_argument("--precision", choices=PRECISION_MODES, default="fp32",
+                              help="Inference precision of the captioning model")
+    tiled_parser.add_argument("--model", help=f"Model name ({', '.join(CAPTION_MODELS)}) or Hub id "
+                                              f"(default: {CAPTION_CHECKPOINT})")
+    tiled_parser.add_argument("--backend", choices=BACKENDS, default="torch",
+                              help="Run the model with PyTorch or with ONNX Runtime")
+    tiled_parser.set_defaults(func=run_caption_tiled)
+
+    ask_parser = subparsers.add_parser("ask", help="Answer a list of questions about every image and write JSONL")
+    ask_parser.add_argument("inputs", nargs="*", help="Image files or directories")
+    ask_parser.add_argument("--file-list", help="Text file with one image path per line")
+    ask_parser.add_argument("-q", "--question", action="append", help="Question to ask (repeatable)")
+    ask_parser.add_argument("--questions-file", help="Text file with one question per line")
+    ask_parser.add_argument("-o", "--output", help="JSONL output file (default: standard output)")
+    ask_parser.add_argument("--max-new-tokens", type=int, default=MAX_NEW_TOKENS)
+    ask_parser.add_argument("--result-cache", default=RESULT_CACHE_PATH, help="SQLite result cache file")
+    ask_parser.add_argument("--no-result-cache", action="store_true", help="Always run the model")
+    ask_parser.add_argument("--snapshot", action="store_true",
+                            help="Load the model from (and create) a memory-mapped weight snapshot")
+    ask_parser.add_argument("--precision", choices=PRECISION_MODES, default="fp32",
+                            help="Inference precision of the VQA model")
+    ask_parser.add_argument("--model", help=f"Model name ({', '.join(QA_MODELS)}) or Hub id "
+                                            f"(default: {QA_CHECKPOINT})")
+    ask_parser.add_argument("--backend", choices=BACKENDS, default="torch",
+                            help="Run the model with PyTorch or with ONNX Runtime")
+    ask_parser.set_defaults(func=run_ask)
+
+    index_parser = subparsers.add_parser(
+        "search-index", help="Add the output of caption-batch, ask or caption-sequence to the search index")
+    index_parser.add_argument("inputs", nargs="+",
+                              help="JSONL output files; only lines added since the last run are read")
+    index_parser.add_argument("--search-index", default=SEARCH_INDEX_PATH, help="SQLite search index file")
+    index_parser.set_defaults(func=run_search_index)
+
+    search_parser = subparsers.add_parser("search", help="Find images by their captions and answers, as JSONL")
+    search_parser.add_argument("query", nargs="+", help="Words to match; the last one may be a prefix")
+    search_parser.add_argument("--limit", type=int, default=SEARCH_RESULT_LIMIT, help="Largest number of images")
+    search_parser.add_argument("--search-index", default=SEARCH_INDEX_PATH, help="SQLite search index file")
+    search_parser.set_defaults(func=run_search)
+
+    invalidate_parser = subparsers.add_parser("cache-invalidate", help="Drop cached captions and answers")
+    invalidate_parser.add_argument("--checkpoint", help="Only drop results of this checkpoint")
+    invalidate_parser.add_argument("--result-cache", default=RESULT_CACHE_PATH, help="SQLite result cache file")
+    invalidate_parser.set_defaults(func=run_cache_invalidate)
+
+    measure_parser = subparsers.add_parser("measure-startup",
+                                           help="Compare startup time and peak RSS of the loading strategies")
+    measure_parser.add_argument("--runs", type=int, default=3, help="Launches per configuration")
+    measure_parser.set_defaults(func=run_measure_startup)
+
+    probe_parser = subparsers.add_parser("startup-probe")
+    probe_parser.add_argument("--mode", choices=["eager", "lazy"], default="lazy")
+    probe_parser.add_argument("--snapshot", action="store_true")
+    probe_parser.set_defaults(func=run_startup_probe)
+
+    compare_parser = subparsers.add_parser("compare-precision",
+                                           help="Compare latency, memory and outputs of the precision modes")
+    compare_parser.add_argument("inputs", nargs="+", help="Image files or directories")
+    compare_parser.add_argument("--task", choices=["caption", "vqa", "both"], default="both")
+    compare_parser.add_argument("--modes", nargs="+", choices=PRECISION_MODES, default=list(PRECISION_MODES))
+    compare_parser.add_argument("--question", action="append", default=None,
+                                help="VQA question to ask about every image (repeatable)")
+    compare_parser.add_argument("--limit", type=int, default=50, help="Maximum number of images")
+    compare_parser.add_argument("--max-new-tokens", type=int, default=MAX_NEW_TOKENS)
+    compare_parser.add_argument("--model", help=f"Model name ({', '.join(CAPTION_MODELS)}, or {', '.join(QA_MODELS)} "
+                                                f"with --task vqa) or Hub id; needs a single --task")
+    compare_parser.set_defaults(func=run_compare_precision)
+
+    precision_probe_parser = subparsers.add_parser("precision-probe")
+    precision_probe_parser.add_argument("inputs", nargs="+")
+    precision_probe_parser.add_argument("--task", choices=["caption", "vqa"], default="caption")
+    precision_probe_parser.add_argument("--precision", choices=PRECISION_MODES, default="fp32")
+    precision_probe_parser.add_argument("--question", action="append", default=None)
+    precision_probe_parser.add_argument("--limit", type=int, default=50)
+    precision_probe_parser.add_argument("--max-new-tokens", type=int, default=MAX_NEW_TOKENS)
+    precision_probe_parser.add_argument("--model")
+    precision_probe_parser.set_defaults(func=run_precision_probe)
+
+    export_parser = subparsers.add_parser("export-onnx",
+                                          help="Export the models for the ONNX Runtime backend and check parity")
+    export_parser.add_argument("--task", choices=["caption", "vqa", "both"], default="both")
+    export_parser.add_argument("--force", action="store_true", help="Re-export even if a cached export exists")
+    export_parser.add_argument("--verify", nargs="*", default=[], metavar="IMAGE",
+                               help="Images or directories to compare torch and ONNX outputs on")
+    export_parser.add_argument("--question", action="append", default=None,
+                               help="VQA question used for the parity check (repeatable)")
+    export_parser.add_argument("--tolerance", type=float, default=1e-3,
+                               help="Largest accepted image-embedding difference")
+    export_parser.add_argument("--max-new-tokens", type=int, default=MAX_NEW_TOKENS)
+    export_parser.add_argument("--model", help=f"Model name ({', '.join(CAPTION_MODELS)}, or {', '.join(QA_MODELS)} "
+                                               f"with --task vqa) or Hub id; needs a single --task")
+    export_parser.set_defaults(func=run_export_onnx)
+
+    benchmark_parser = subparsers.add_parser(
+        "benchmark", help="Time model load, decode, preprocessing and generation and write the results as JSON")
+    benchmark_parser.add_argument("--tiny", action="store_true",
+                                  help="Use tiny randomly initialised BLIP models (no download or network needed)")
+    benchmark_parser.add_argument("--images", nargs="*", default=None,
+                                  help="Image files or directories (default: synthetic JPEGs of several sizes)")
+    benchmark_parser.add_argument("--backend", choices=BACKENDS, default="torch")
+    benchmark_parser.add_argument("--precision", choices=PRECISION_MODES, default="fp32")
+    benchmark_parser.add_argument("--repeat", type=int, default=5, help="Timed runs per stage")
+    benchmark_parser.add_argument("--batch-sizes", type=int, nargs="+", default=list(BENCHMARK_BATCH_SIZES))
+    benchmark_parser.add_argument("--max-new-tokens", type=int, default=MAX_NEW_TOKENS)
+    benchmark_parser.add_argument("-o", "--output", help="JSON report file (default: standard output)")
+    benchmark_parser.add_argument("--baseline", help="Earlier JSON report to compare against")
+    benchmark_parser.add_argument("--tolerance", type=float, default=0.2,
+                                  help="Allowed slowdown against the baseline before a stage counts as a regression")
+    benchmark_parser.set_defaults(func=run_benchmark)
+
+    serve_parser = subparsers.add_parser("serve", help="Serve /caption and /vqa over HTTP with micro-batching")
+    serve_parser.add_argument("--host", default=SERVER_HOST)
+    serve_parser.add_argument("--port", type=int, default=SERVER_PORT)
+    serve_parser.add_argument("--max-batch-size", type=int, default=SERVER_MAX_BATCH_SIZE,
+                              help="Largest number of requests generated together")
+    serve_parser.add_argument("--max-wait-ms", type=float, default=SERVER_MAX_WAIT_MS,
+                              help="How long the first request of a batch waits for others")
+    serve_parser.add_argument("--snapshot", action="store_true",
+                              help="Load models from (and create) memory-mapped weight snapshots")
+    serve_parser.add_argument("--caption-precision", choices=PRECISION_MODES, default="fp32")
+    serve_parser.add_argument("--qa-precision", choices=PRECISION_MODES, default="fp32")
+    serve_parser.add_argument("--backend", choices=BACKENDS, default="torch")
+    serve_parser.add_argument("--result-cache", default=RESULT_CACHE_PATH, help="SQLite result cache file")
+    serve_parser.add_argument("--search-index", default=SEARCH_INDEX_PATH,
+                              help="SQLite search index file served by GET /search")
+    serve_parser.add_argument("--near-duplicate-threshold", type=int, default=NEAR_DUPLICATE_THRESHOLD,
+                              help="Reuse the caption of an image whose perceptual hash differs in at most this "
+                                   "many bits (-1: never)")
+    serve_parser.add_argument("--model-memory-mb", type=int, default=MODEL_MEMORY_BUDGET_MB,
+                              help="Memory for loaded models; least recently used models are unloaded beyond it")
+    serve_parser.add_argument("--model-idle-timeout", type=float, default=MODEL_IDLE_TIMEOUT,
+                              help="Seconds after which an unused model is unloaded (0: never)")
+    serve_parser.add_argument("--replicas", type=int, default=0,
+                              help="Worker processes per model, sharing its memory-mapped weights (0: run the "
+                                   "models in the server process)")
+    serve_parser.add_argument("--thread-policy", choices=THREAD_POLICIES, default="default",
+                              help="How the caption and VQA models share the CPU cores")
+    serve_parser.add_argument("--pin-cores", action="store_true",
+                              help="With the throughput policy, bind each model to its own cores")
+    serve_parser.add_argument("--metrics-jsonl", metavar="PATH", help="Append the stage timings of every batch")
+    serve_parser.add_argument("--metrics-prom", metavar="PATH", help="Prometheus text file kept up to date")
+    serve_parser.set_defaults(func=run_server)
+    return parser
+
+
+if __name__ == "__main__":
+    args = build_arg_parser().parse_args()
+    sys.exit(args.func(args))
 
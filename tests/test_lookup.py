@@ -0,0 +1,53 @@
+import os
+
+import pytest
+
+import ImageCaptionGeneratorVqa as app
+
+
+@pytest.fixture
+def checkpoint(tmp_path):
+    path = tmp_path / "checkpoint"
+    path.mkdir()
+    return str(path)
+
+
+@pytest.fixture
+def image_path(tmp_path):
+    path = tmp_path / "image.png"
+    app.Image.new("RGB", (8, 8), "red").save(path)
+    return str(path)
+
+
+def params(precision="fp32"):
+    return {"max_new_tokens": app.MAX_NEW_TOKENS, "precision": precision}
+
+
+def test_caption_lookup_misses_after_revision_change(tmp_path, checkpoint, image_path):
+    cache_path = str(tmp_path / "results.sqlite3")
+    app.ResultCache(cache_path).put("caption", app.hash_image_file(image_path), checkpoint, "a red square",
+                                    params=params())
+
+    def lookup():
+        cache = app.ResultCache(cache_path)
+        generator = app.CaptionGenerator(app.ModelRegistry(idle_timeout=0, result_cache=cache), cache)
+        return generator.lookup(app.InferenceRequest(1, image_path, model=checkpoint))
+
+    assert lookup() == "a red square"
+    os.utime(checkpoint, (1, 1))
+    assert lookup() is None
+
+
+def test_answer_lookup_misses_after_revision_change(tmp_path, checkpoint, image_path):
+    cache_path = str(tmp_path / "results.sqlite3")
+    app.ResultCache(cache_path).put("answer", app.hash_image_file(image_path), checkpoint, "red",
+                                    "what color?", params())
+
+    def lookup():
+        cache = app.ResultCache(cache_path)
+        generator = app.QuestionAnswerGenerator(app.ModelRegistry(idle_timeout=0, result_cache=cache), None, cache)
+        return generator.lookup(app.InferenceRequest(1, image_path, "what color?", model=checkpoint))
+
+    assert lookup() is not None
+    os.utime(checkpoint, (1, 1))
+    assert lookup() is None
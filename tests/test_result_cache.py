@@ -0,0 +1,25 @@
+import os
+
+import ImageCaptionGeneratorVqa as app
+
+
+def test_lookup_misses_after_checkpoint_revision_changes(tmp_path):
+    checkpoint = str(tmp_path / "checkpoint")
+    os.mkdir(checkpoint)
+    path = str(tmp_path / "results.sqlite3")
+    cache = app.ResultCache(path)
+    cache.put("caption", "image", checkpoint, "a cat")
+    assert cache.get("caption", "image", checkpoint) == "a cat"
+
+    # A process that starts after the checkpoint was updated misses before loading the model
+    os.utime(checkpoint, (1, 1))
+    assert app.ResultCache(path).get("caption", "image", checkpoint) is None
+
+
+def test_lookup_hits_while_checkpoint_is_unchanged(tmp_path):
+    checkpoint = str(tmp_path / "checkpoint")
+    os.mkdir(checkpoint)
+    path = str(tmp_path / "results.sqlite3")
+    app.ResultCache(path).put("caption", "image", checkpoint, "a cat")
+    assert app.ResultCache(path).get("caption", "image", checkpoint) == "a cat"
+    assert app.ResultCache(path).get("caption", "image", checkpoint) == "a cat"
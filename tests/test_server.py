@@ -0,0 +1,43 @@
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+import ImageCaptionGeneratorVqa as app
+
+
+class StubService:
+    # Answers every question with its own text, in the shape InferenceService returns
+    search_index = None
+
+    def answer(self, image_bytes, question, model=None):
+        return f"{question} ({len(image_bytes)} bytes)"
+
+    def answers(self, image_bytes, questions, model=None):
+        return [self.answer(image_bytes, question, model) for question in questions]
+
+
+@pytest.fixture
+def client():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), app.InferenceRequestHandler)
+    server.service = StubService()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield app.InferenceClient(f"http://127.0.0.1:{server.server_address[1]}")
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def image_path(tmp_path):
+    path = tmp_path / "image.png"
+    path.write_bytes(b"12345")
+    return str(path)
+
+
+def test_answer_one_question(client, image_path):
+    assert client.answers(image_path, ["what?"]) == ["what? (5 bytes)"]
+    assert client.answer(image_path, "what?") == "what? (5 bytes)"
+
+
+def test_answer_several_questions(client, image_path):
+    assert client.answers(image_path, ["what?", "who?"]) == ["what? (5 bytes)", "who? (5 bytes)"]